@@ -0,0 +1,326 @@
+"""Benchmark of map generation, rendering and serialization, without a database.
+
+The features come from synthetic profiles, a dense city block and a sparse
+countryside, or from fixtures recorded from a real database with --record.
+Results can be saved and compared with a previous run to spot regressions:
+
+    python -m tiled_maps.benchmark --output before.json
+    python -m tiled_maps.benchmark --baseline before.json
+    python -m tiled_maps.benchmark --record 17601 10742 15 berlin.json
+    python -m tiled_maps.benchmark --fixture berlin.json --resolutions 80
+"""
+
+import argparse
+from io import BytesIO
+import json
+from pathlib import Path
+import platform
+import statistics
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+import orjson
+import shapely
+from shapely.affinity import rotate
+from shapely.geometry import LineString, Point, box, shape
+
+from tiled_maps.coordinates import tile_envelope
+from tiled_maps.raster import render_tilemap
+from tiled_maps.tiled_helpers import tilemap
+from tiled_maps.tiled_helpers.tile_catalog import (
+    TILESETS_FOLDER,
+    get_catalog,
+    scan_tileset_folder,
+)
+from tiled_maps.tilegen.generate import build_map, represent_feature
+from tiled_maps.tilegen.rules import get_rules
+
+# a tile of Berlin at the game zoom level of the example configuration
+DEFAULT_TILE = (17601, 10742, 15)
+# a stage is a regression when its median is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.2
+# where the benchmark maps pretend to be, for the relative tileset paths
+MAP_PATH = Path("demo_tilegame2/maps/generated/benchmark.json")
+
+Feature = tuple[int, shape, dict]
+
+
+def dense_features(
+    bbox: tuple[float, float, float, float], seed: int = 0
+) -> list[Feature]:
+    """A city: a street grid with named roads, blocks of buildings, street
+    trees, some parks and footways, a river and things no rule draws"""
+    rng = np.random.default_rng(seed)
+    min_x, max_x, min_y, max_y = bbox
+    side = max_x - min_x
+    ret: list[Feature] = []
+
+    def add(geom, tags):
+        ret.append((len(ret) + 1, geom, tags))
+
+    spacing = 100.0
+    streets = np.arange(min_x - spacing / 2, max_x + spacing, spacing)
+    for idx, sx in enumerate(streets):
+        kind = "primary" if idx % 5 == 0 else "residential"
+        add(
+            LineString([(sx, min_y - 50), (sx, max_y + 50)]),
+            dict(highway=kind, name=f"Street {idx}"),
+        )
+        sy = min_y - spacing / 2 + idx * spacing
+        add(
+            LineString([(min_x - 50, sy), (max_x + 50, sy)]),
+            dict(highway="secondary" if idx % 4 == 0 else "residential"),
+        )
+    for bx in streets[:-1]:
+        for by in np.arange(min_y - spacing / 2, max_y, spacing):
+            if rng.random() < 0.1:
+                add(box(bx + 10, by + 10, bx + 90, by + 90), dict(landuse="grass"))
+                continue
+            for _ in range(8):
+                x0 = bx + rng.uniform(8, 70)
+                y0 = by + rng.uniform(8, 70)
+                w, h = rng.uniform(10, 25, 2)
+                add(box(x0, y0, x0 + w, y0 + h), dict(building="yes"))
+    for _ in range(400):
+        sx = rng.choice(streets) + 6
+        add(Point(sx, rng.uniform(min_y, max_y)), dict(natural="tree"))
+    for _ in range(60):
+        x0, y0 = rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)
+        add(
+            LineString(
+                [(x0, y0), (x0 + rng.uniform(-80, 80), y0 + rng.uniform(-80, 80))]
+            ),
+            dict(highway="footway"),
+        )
+    river_y = min_y + side * rng.uniform(0.3, 0.7)
+    add(
+        LineString([(min_x - 100, river_y), (max_x + 100, river_y + 80)]).buffer(25),
+        dict(natural="water"),
+    )
+    for _ in range(300):
+        add(
+            Point(rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)),
+            dict(amenity="bench"),
+        )
+    return ret
+
+
+def sparse_features(
+    bbox: tuple[float, float, float, float], seed: int = 0
+) -> list[Feature]:
+    """The countryside: a few long roads, farms, big meadows, a lake and
+    scattered trees"""
+    rng = np.random.default_rng(seed)
+    min_x, max_x, min_y, max_y = bbox
+    ret: list[Feature] = []
+
+    def add(geom, tags):
+        ret.append((len(ret) + 1, geom, tags))
+
+    def random_point():
+        return rng.uniform(min_x, max_x), rng.uniform(min_y, max_y)
+
+    for idx in range(4):
+        points = [random_point() for _ in range(6)]
+        add(LineString(sorted(points)), dict(highway="secondary", name=f"Road {idx}"))
+    for _ in range(6):
+        x0, y0 = random_point()
+        size = rng.uniform(200, 500)
+        add(
+            rotate(box(x0, y0, x0 + size, y0 + size * 0.6), 20),
+            dict(landuse="grass"),
+        )
+    for _ in range(12):
+        x0, y0 = random_point()
+        add(box(x0, y0, x0 + 20, y0 + 12), dict(building="farm"))
+    x0, y0 = random_point()
+    add(Point(x0, y0).buffer(rng.uniform(60, 150)), dict(natural="water"))
+    for _ in range(80):
+        add(Point(*random_point()), dict(natural="tree"))
+    return ret
+
+
+PROFILES: dict[str, Callable[..., list[Feature]]] = {
+    "dense": dense_features,
+    "sparse": sparse_features,
+}
+
+
+def save_fixture(path: Path, bbox: tuple, features: list[Feature]) -> None:
+    """Store features, with the geometries as WKB, to benchmark them later"""
+    data = dict(
+        bbox=list(bbox),
+        features=[
+            [osm_id, shapely.to_wkb(geom, hex=True), tags]
+            for osm_id, geom, tags in features
+        ],
+    )
+    path.write_bytes(orjson.dumps(data))
+
+
+def load_fixture(path: Path) -> tuple[tuple, list[Feature]]:
+    data = orjson.loads(path.read_bytes())
+    return tuple(data["bbox"]), [
+        (osm_id, shapely.from_wkb(wkb), tags) for osm_id, wkb, tags in data["features"]
+    ]
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict[str, float]:
+    """Run fn repeat times, after a warm up run, times are in milliseconds"""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return dict(median_ms=statistics.median(times), min_ms=min(times))
+
+
+def benchmark_features(
+    name: str,
+    bbox: tuple,
+    features: list[Feature],
+    tiles: int,
+    repeat: int,
+) -> dict[str, dict[str, float]]:
+    """All the stages for a set of features at a map resolution"""
+    catalog = get_catalog()
+    rules = get_rules(catalog)
+    min_x, max_x, min_y, max_y = bbox
+    cell_width = (max_x - min_x) / tiles
+    cell_height = (max_y - min_y) / tiles
+
+    def represent_all():
+        for osm_id, geom, tags in features:
+            represent_feature(
+                osm_id, geom, tags, rules, bbox, cell_width, cell_height, tiles, tiles
+            )
+
+    def build():
+        return build_map(MAP_PATH, features, bbox, tiles, catalog)
+
+    tm = build()
+    serialized = tm.to_json_bytes()
+    # from_data handles only tile layers, like the encoding benchmark
+    raw_map = orjson.loads(serialized)
+    raw_map["layers"] = [l for l in raw_map["layers"] if l["type"] == "tilelayer"]
+    tile_layers_only = orjson.dumps(raw_map)
+
+    def render_png():
+        buffer = BytesIO()
+        render_tilemap(tm).save(buffer, format="png")
+
+    stages = {
+        "build_map": build,
+        "represent_feature": represent_all,
+        "to_dict": tm.to_dict,
+        "to_json_bytes": tm.to_json_bytes,
+        "from_data": lambda: tilemap.from_data(
+            orjson.loads(tile_layers_only) | dict(path=str(MAP_PATH))
+        ),
+        "render_png": render_png,
+    }
+    return {
+        f"{stage}/{name}/{tiles}": measure(fn, repeat) for stage, fn in stages.items()
+    }
+
+
+def compare(
+    results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]]
+) -> list[str]:
+    """Print the changes from the baseline, returns the regressed benchmarks"""
+    regressions = []
+    for key, res in results.items():
+        if key not in baseline:
+            continue
+        ratio = res["median_ms"] / baseline[key]["median_ms"]
+        flag = ""
+        if ratio > REGRESSION_THRESHOLD:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:<40} {baseline[key]['median_ms']:>10.2f} -> ", end="")
+        print(f"{res['median_ms']:>10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def record(x: int, y: int, z: int, out: Path) -> None:
+    """Dump the features of a tile from the database as a fixture"""
+    from tiled_maps.database import open_connection, retrieve_features
+
+    bbox = tile_envelope(x, y, z)
+    with open_connection() as conn:
+        features = list(retrieve_features(x, y, z, conn))
+    save_fixture(out, bbox, features)
+    print(f"Saved {len(features)} features of {x, y, z} to {out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=list(PROFILES),
+        default=list(PROFILES),
+        help="synthetic feature sets to benchmark",
+    )
+    parser.add_argument(
+        "--fixture",
+        nargs="*",
+        type=Path,
+        default=[],
+        help="recorded feature sets to benchmark, instead of the profiles",
+    )
+    parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        type=int,
+        default=[40, 80, 160],
+        help="TILE_RESOLUTION values to benchmark",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="save the results in this file")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="compare with these saved results, exit with 1 on regressions",
+    )
+    parser.add_argument(
+        "--record",
+        nargs=4,
+        metavar=("X", "Y", "Z", "FILE"),
+        help="save the features of a tile from the database as a fixture and exit",
+    )
+    args = parser.parse_args()
+    if args.record is not None:
+        x, y, z, out = args.record
+        record(int(x), int(y), int(z), Path(out))
+        sys.exit(0)
+
+    if len(args.fixture) > 0:
+        feature_sets = {p.stem: load_fixture(p) for p in args.fixture}
+    else:
+        bbox = tile_envelope(*DEFAULT_TILE)
+        feature_sets = {name: (bbox, PROFILES[name](bbox)) for name in args.profiles}
+    results = {
+        f"scan_tileset_folder/{TILESETS_FOLDER.name}": measure(
+            lambda: scan_tileset_folder(TILESETS_FOLDER), args.repeat
+        )
+    }
+    for name, (bbox, features) in feature_sets.items():
+        for tiles in args.resolutions:
+            print(f"{name}, {len(features)} features, {tiles}x{tiles} cells")
+            results |= benchmark_features(name, bbox, features, tiles, args.repeat)
+    for key, res in results.items():
+        print(f"{key:<40} {res['median_ms']:>10.2f} ms (min {res['min_ms']:.2f})")
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps(
+                dict(python=platform.python_version(), results=results), indent=2
+            )
+        )
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        if len(compare(results, baseline)) > 0:
+            sys.exit(1)
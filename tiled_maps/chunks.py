@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+import fcntl
+from os import environ
+from pathlib import Path
+import re
+from typing import Generator, TextIO
+
+import orjson
+
+from tiled_maps.feature_index import record_chunk
+from tiled_maps.feature_source import FeatureSource
+from tiled_maps.metrics import timed
+from tiled_maps.static_files import write_atomic, write_precompressed
+from tiled_maps.tiled_helpers import tilemap
+from tiled_maps.tiled_helpers.tilemap import TiledMap
+from tiled_maps.tilegen import generate
+from tiled_maps import world_store
+
+WORLD_CENTER_X = int(environ["WORLD_CENTER_X"])
+WORLD_CENTER_Y = int(environ["WORLD_CENTER_Y"])
+GAME_ZOOM_LEVEL = int(environ["GAME_ZOOM_LEVEL"])
+TILE_RESOLUTION = int(environ["TILE_RESOLUTION"])
+
+BASE_FOLDER = Path("demo_tilegame2")
+GENERATED_FOLDER = BASE_FOLDER / "maps" / "generated"
+# which features are in which chunk, see feature_index, not in the served folder
+FEATURE_INDEX_PATH = Path(environ.get("FEATURE_INDEX_PATH", "feature_index.sqlite"))
+# one lock file per chunk, shared by all the processes generating chunks
+LOCKS_FOLDER = Path(environ.get("CHUNK_LOCKS_DIR", "chunk_locks"))
+# when set the chunks go in a world_store instead of a file each
+WORLD_STORE_PATH = (
+    Path(environ["WORLD_STORE_PATH"]) if environ.get("WORLD_STORE_PATH") else None
+)
+
+CHUNK_NAME_REGEX = re.compile(r"chunk_(-?\d+)_(-?\d+)\.json")
+
+
+def chunk_to_tile(x: int, y: int) -> tuple[int, int]:
+    """XYZ tile coordinates, at the game zoom level, of a chunk"""
+    return WORLD_CENTER_X + x, WORLD_CENTER_Y + y
+
+
+def tile_to_chunk(x: int, y: int) -> tuple[int, int]:
+    """Chunk coordinates of a XYZ tile at the game zoom level"""
+    return x - WORLD_CENTER_X, y - WORLD_CENTER_Y
+
+
+def chunk_path(x: int, y: int) -> Path:
+    return GENERATED_FOLDER / f"chunk_{x}_{y}.json"
+
+
+def generate_chunk(x: int, y: int, source: FeatureSource) -> TiledMap:
+    """Generate the map of a chunk, without persisting it"""
+    geo_x, geo_y = chunk_to_tile(x, y)
+    return generate.generate_map(
+        chunk_path(x, y), geo_x, geo_y, GAME_ZOOM_LEVEL, source, tiles=TILE_RESOLUTION
+    )
+
+
+def generate_chunks(
+    coords: list[tuple[int, int]], source: FeatureSource, region: bool = False
+) -> dict[tuple[int, int], TiledMap]:
+    """Generate the maps of many neighbouring chunks fetching the data once.
+
+    With region every feature is drawn once for all the chunks, see
+    generate.build_region.
+    """
+    tile_coords = {chunk_to_tile(x, y): (x, y) for x, y in coords}
+    generate_block = generate.generate_region if region else generate.generate_map_block
+    maps = generate_block(
+        {xy: chunk_path(*chunk) for xy, chunk in tile_coords.items()},
+        GAME_ZOOM_LEVEL,
+        source,
+        tiles=TILE_RESOLUTION,
+    )
+    return {tile_coords[xy]: tm for xy, tm in maps.items()}
+
+
+def existing_chunks() -> set[tuple[int, int]]:
+    """Coordinates of the chunks already generated"""
+    if WORLD_STORE_PATH is not None:
+        return world_store.stored_chunks(WORLD_STORE_PATH)
+    ret = set()
+    for p in GENERATED_FOLDER.glob("chunk_*_*.json"):
+        match = CHUNK_NAME_REGEX.fullmatch(p.name)
+        if match is not None:
+            ret.add((int(match.group(1)), int(match.group(2))))
+    return ret
+
+
+def lock_chunk(x: int, y: int) -> TextIO:
+    """Wait for an exclusive lock on a chunk, across processes.
+
+    Release it with unlock_chunk, the lock is also released if the process
+    dies. Whoever holds it is the only one generating or writing the chunk.
+    """
+    LOCKS_FOLDER.mkdir(parents=True, exist_ok=True)
+    lock_file = open(LOCKS_FOLDER / f"chunk_{x}_{y}.lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def unlock_chunk(lock_file: TextIO) -> None:
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+@contextmanager
+def chunk_lock(x: int, y: int) -> Generator[None, None, None]:
+    lock_file = lock_chunk(x, y)
+    try:
+        yield
+    finally:
+        unlock_chunk(lock_file)
+
+
+def chunk_exists(x: int, y: int) -> bool:
+    if WORLD_STORE_PATH is not None:
+        return world_store.chunk_version(WORLD_STORE_PATH, x, y) is not None
+    return chunk_path(x, y).is_file()
+
+
+def load_chunk(x: int, y: int) -> tuple[TiledMap, int] | None:
+    """The map of a chunk in the world store and its version"""
+    return world_store.load_map(WORLD_STORE_PATH, x, y, chunk_path(x, y))
+
+
+def read_chunk_map(x: int, y: int) -> TiledMap:
+    """The tile layers of a generated chunk, from its file or the world store"""
+    if WORLD_STORE_PATH is not None:
+        return load_chunk(x, y)[0]
+    p = chunk_path(x, y)
+    raw_map = orjson.loads(p.read_bytes())
+    # the events layer is not a tile layer, rendering does not need it
+    raw_map["layers"] = [l for l in raw_map["layers"] if l["type"] == "tilelayer"]
+    return tilemap.from_data(raw_map | dict(path=p))
+
+
+def stored_chunk_json(x: int, y: int) -> tuple[bytes, int] | None:
+    """Tiled JSON of a chunk in the world store and its version"""
+    loaded = load_chunk(x, y)
+    if loaded is None:
+        return None
+    tm, version = loaded
+    with timed("serialize"):
+        return tm.to_json_bytes(), version
+
+
+def save_chunk(tm: TiledMap, x: int, y: int) -> bytes:
+    """Write the map of a chunk and its event files, returns the map Tiled JSON.
+
+    The files, or the world store entry, are replaced atomically, so a chunk
+    can be regenerated while being served. Hold the chunk_lock to avoid
+    concurrent generations.
+    """
+    if WORLD_STORE_PATH is None:
+        data_repr = write_chunk_files(tm, x, y)
+    else:
+        with timed("serialize"):
+            data_repr = tm.to_json_bytes()
+        with timed("write"):
+            world_store.put_chunk(WORLD_STORE_PATH, x, y, tm)
+    if tm.feature_ids is not None:
+        with timed("write"):
+            record_chunk(FEATURE_INDEX_PATH, x, y, tm.feature_ids)
+    return data_repr
+
+
+def write_chunk_files(tm: TiledMap, x: int, y: int) -> bytes:
+    """Write the map of a chunk and its event files, with compressed variants"""
+    p = chunk_path(x, y)
+    with timed("serialize"):
+        data_repr = tm.to_json_bytes()
+    written = set()
+    with timed("write"):
+        for relpath, content in tm.get_event_files():
+            event_path = p.parent / relpath
+            write_atomic(event_path, content.encode())
+            written.add(event_path)
+        # the map is replaced only when its events are there
+        write_atomic(p, data_repr)
+        # events of a previous version of the chunk
+        for old in p.parent.glob(f"{p.stem}_*.json"):
+            if old not in written:
+                old.unlink(missing_ok=True)
+    with timed("compress"):
+        write_precompressed(p, data_repr)
+    return data_repr
@@ -0,0 +1,236 @@
+"""Pack the tiles used by the generated chunks into a single tileset.
+
+Chunks reference every tileset of the catalog, so clients load all the
+spritesheets to draw a few kinds of tiles. This collects the tiles the
+chunks of an area actually use, copies them in one atlas image with its
+tileset and rewrites the chunks to reference only that, for example:
+
+    python -m tiled_maps.compact_tilesets
+    python -m tiled_maps.compact_tilesets --chunks -10 -10 10 10
+
+The atlas files are named after their content, so maps referencing a
+previous atlas keep working. Chunks generated later reference the whole
+catalog again, run this after pregenerate and regenerate.
+"""
+
+import argparse
+from hashlib import sha1
+from io import BytesIO
+import math
+from os.path import relpath
+from pathlib import Path
+
+import numpy as np
+import orjson
+from PIL import Image
+
+from tiled_maps.chunks import (
+    GENERATED_FOLDER,
+    WORLD_STORE_PATH,
+    chunk_lock,
+    chunk_path,
+    existing_chunks,
+)
+from tiled_maps.raster import sliced_tileset
+from tiled_maps.static_files import write_atomic, write_precompressed
+from tiled_maps.tiled_helpers.encoding import decode_layer_data, encode_layer_data
+from tiled_maps.tiled_helpers.tileset import TileSet, load_tileset
+
+ATLAS_FOLDER = GENERATED_FOLDER / "tilesets"
+# the highest bits of a tile id are the flip flags of Tiled
+GID_MASK = 0x0FFFFFFF
+
+# a tile, as the resolved path of its tileset and the id inside it
+TileKey = tuple[str, int]
+
+
+def _read_map(p: Path) -> dict:
+    return orjson.loads(p.read_bytes())
+
+
+def _tile_layers(raw_map: dict):
+    """Yields the tile layers of a map with their decoded data"""
+    for layer in raw_map["layers"]:
+        if layer["type"] == "tilelayer":
+            yield layer, decode_layer_data(
+                layer["data"],
+                layer.get("encoding", "csv"),
+                layer.get("compression", ""),
+            )
+
+
+def tile_keys(p: Path, raw_map: dict, gids: np.ndarray) -> dict[int, TileKey]:
+    """The tile of each of the given ids, without flags, in a map"""
+    refs = sorted(raw_map["tilesets"], key=lambda ref: ref["firstgid"])
+    firstgids = [ref["firstgid"] for ref in refs]
+    tilesets = [load_tileset(p.parent / ref["source"]) for ref in refs]
+    owners = np.searchsorted(firstgids, gids, side="right") - 1
+    ret = {}
+    for gid, owner in zip(gids.tolist(), owners.tolist()):
+        if owner < 0 or gid - firstgids[owner] >= tilesets[owner].tilecount:
+            raise ValueError(f"Tile {gid} of {p} is in no tileset")
+        ts = tilesets[owner]
+        ret[gid] = (str(Path(ts.path).resolve()), gid - firstgids[owner])
+    return ret
+
+
+def used_tiles(p: Path, raw_map: dict) -> dict[int, TileKey]:
+    """The tiles used by a map, by their id in it"""
+    gids = [np.unique(data & GID_MASK) for _, data in _tile_layers(raw_map)]
+    if len(gids) == 0:
+        return {}
+    gids = np.unique(np.concatenate(gids))
+    return tile_keys(p, raw_map, gids[gids != 0])
+
+
+def build_atlas(
+    keys: list[TileKey], tilewidth: int, tileheight: int
+) -> tuple[bytes, dict]:
+    """The PNG with the given tiles, in this order, and its tileset.
+
+    The image path and the name in the tileset are left to the caller.
+    """
+    columns = max(math.ceil(math.sqrt(len(keys))), 1)
+    rows = max(math.ceil(len(keys) / columns), 1)
+    pixels = np.zeros((rows * tileheight, columns * tilewidth, 4), dtype=np.uint8)
+    tile_defs = []
+    tilesets: dict[str, TileSet] = {}
+    for new_id, (ts_path, local_id) in enumerate(keys):
+        if ts_path not in tilesets:
+            ts = load_tileset(ts_path)
+            if (ts.tilewidth, ts.tileheight) != (tilewidth, tileheight):
+                raise ValueError(
+                    f"Tiles of {ts_path} are {ts.tilewidth}x{ts.tileheight}, "
+                    f"the atlas ones {tilewidth}x{tileheight}"
+                )
+            tilesets[ts_path] = ts
+        ts = tilesets[ts_path]
+        tiles = sliced_tileset(
+            str(Path(ts.path).parent / ts.image),
+            ts.tilewidth,
+            ts.tileheight,
+            ts.columns,
+            ts.tilecount,
+            ts.margin,
+            ts.spacing,
+        )
+        top = (new_id // columns) * tileheight
+        left = (new_id % columns) * tilewidth
+        pixels[top : top + tileheight, left : left + tilewidth] = tiles[local_id]
+        # properties like the name, used to find tiles, go with the tile
+        for tile_def in ts.tiles or []:
+            if tile_def.id == local_id:
+                tile_defs.append(dict(id=new_id, properties=tile_def.properties))
+    png = BytesIO()
+    Image.fromarray(pixels, "RGBA").save(png, "PNG")
+    tileset = dict(
+        columns=columns,
+        imageheight=rows * tileheight,
+        imagewidth=columns * tilewidth,
+        margin=0,
+        spacing=0,
+        tilecount=len(keys),
+        tiledversion="1.10.1",
+        tileheight=tileheight,
+        tilewidth=tilewidth,
+        type="tileset",
+        version="1.10",
+        tiles=tile_defs,
+    )
+    return png.getvalue(), tileset
+
+
+def write_atlas(keys: list[TileKey], tilewidth: int, tileheight: int) -> Path:
+    """Write the atlas of the tiles in ATLAS_FOLDER, returns its tileset path"""
+    png, tileset = build_atlas(keys, tilewidth, tileheight)
+    name = f"atlas_{sha1(png).hexdigest()[:12]}"
+    ATLAS_FOLDER.mkdir(exist_ok=True)
+    image_path = ATLAS_FOLDER / f"{name}.png"
+    tileset_path = ATLAS_FOLDER / f"{name}.json"
+    write_atomic(image_path, png)
+    tileset |= dict(name=name, image=image_path.name)
+    write_atomic(tileset_path, orjson.dumps(tileset))
+    return tileset_path
+
+
+def remap_map(
+    p: Path, raw_map: dict, new_gids: dict[TileKey, int], atlas: Path
+) -> bool:
+    """Make a map use the atlas, False if it has tiles that are not there"""
+    keys = used_tiles(p, raw_map)
+    if any(key not in new_gids for key in keys.values()):
+        return False
+    for layer, data in _tile_layers(raw_map):
+        gids, inverse = np.unique(data & GID_MASK, return_inverse=True)
+        lookup = np.array(
+            [0 if gid == 0 else new_gids[keys[gid]] for gid in gids.tolist()],
+            dtype=np.uint32,
+        )
+        layer["data"] = encode_layer_data(
+            lookup[inverse.ravel()] | (data & ~np.uint32(GID_MASK)),
+            layer.get("encoding", "csv"),
+            layer.get("compression", ""),
+            raw_map.get("compressionlevel", -1),
+        )
+    raw_map["tilesets"] = [dict(firstgid=1, source=relpath(atlas, p.parent))]
+    return True
+
+
+def compact_chunks(chunks: list[tuple[int, int]]) -> Path | None:
+    """Make the chunks use a single atlas with only their tiles.
+
+    Chunks regenerated meanwhile with new tiles are left untouched.
+    Returns the tileset of the atlas, None if there are no chunks.
+    """
+    if len(chunks) == 0:
+        return None
+    used: set[TileKey] = set()
+    tile_sizes = set()
+    for x, y in chunks:
+        p = chunk_path(x, y)
+        raw_map = _read_map(p)
+        used.update(used_tiles(p, raw_map).values())
+        tile_sizes.add((raw_map["tilewidth"], raw_map["tileheight"]))
+    if len(tile_sizes) > 1:
+        raise ValueError(f"The chunks have different tile sizes: {tile_sizes}")
+    keys = sorted(used)
+    atlas = write_atlas(keys, *tile_sizes.pop())
+    new_gids = {key: idx + 1 for idx, key in enumerate(keys)}
+    skipped = 0
+    for x, y in chunks:
+        p = chunk_path(x, y)
+        # a regeneration must not happen between reading and writing
+        with chunk_lock(x, y):
+            raw_map = _read_map(p)
+            if not remap_map(p, raw_map, new_gids, atlas):
+                skipped += 1
+                continue
+            content = orjson.dumps(raw_map)
+            write_atomic(p, content)
+            write_precompressed(p, content)
+    print(
+        f"Packed {len(keys)} tiles in {atlas}, "
+        f"{len(chunks) - skipped} chunks updated, {skipped} changed meanwhile"
+    )
+    return atlas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--chunks",
+        nargs=4,
+        type=int,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="rectangle of chunk coordinates, extremes included, default all",
+    )
+    args = parser.parse_args()
+    if WORLD_STORE_PATH is not None:
+        parser.error("the chunks are in the world store, export them first")
+    chunks = existing_chunks()
+    if args.chunks is not None:
+        min_x, min_y, max_x, max_y = args.chunks
+        chunks = {
+            (x, y) for x, y in chunks if min_x <= x <= max_x and min_y <= y <= max_y
+        }
+    compact_chunks(sorted(chunks))
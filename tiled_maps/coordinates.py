@@ -1,42 +1,135 @@
-from math import atan, sinh, pi, degrees
+"""Tile math for XYZ tiles, in degrees and in EPSG:3857.
 
+Every function accepts numbers or NumPy arrays of the same shape, to
+process many tiles at once, and returns numbers or arrays accordingly.
+Check tile_envelope against PostGIS with:
 
-def tile_bounds(x: int, y: int, zoom: int):
-    # zoom factor
+    python -m tiled_maps.coordinates --check-db
+"""
+
+import numpy as np
+
+# half the side of the EPSG:3857 square, the bounds of st_tileenvelope
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+
+def _unwrap(value):
+    """Plain Python numbers for 0-dimensional arrays, arrays untouched"""
+    if isinstance(value, np.generic) or (
+        isinstance(value, np.ndarray) and value.ndim == 0
+    ):
+        return value.item()
+    return value
+
+
+def swap_y(y, zoom: int):
+    """Flip the Y of a tile, like the swap_z option of the database queries"""
+    return _unwrap(2**zoom - np.asarray(y))
+
+
+def tile_size_meters(zoom: int) -> float:
+    """Side of a tile in EPSG:3857 units, the same for every tile of a zoom"""
+    return 2 * WEB_MERCATOR_EXTENT / 2**zoom
+
+
+def tile_envelope(x, y, zoom: int, swap_z: bool = False) -> tuple:
+    """Bounds of tiles in EPSG:3857 as min_x, max_x, min_y, max_y.
+
+    The values are computed the same way as st_tileenvelope does, so they
+    are the same as the database would give.
+    """
+    if swap_z:
+        y = swap_y(y, zoom)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = tile_size_meters(zoom)
+    return (
+        _unwrap(-WEB_MERCATOR_EXTENT + size * x),
+        _unwrap(-WEB_MERCATOR_EXTENT + size * (x + 1)),
+        _unwrap(WEB_MERCATOR_EXTENT - size * (y + 1)),
+        _unwrap(WEB_MERCATOR_EXTENT - size * y),
+    )
+
+
+def tile_to_deg(x, y, zoom: int) -> tuple:
+    """Latitude and longitude of the north west corner of tiles"""
     n = 2**zoom
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
     # longitude is a simple division of the circle
-    # TODO extra pairs are calculated in case this tile "wraps"
-    # and goes over the international date line and/or the poles
-    lon1 = x / n * 360.0 - 180.0
-    lon2 = (x + 1) / n * 360.0 - 180.0
-    lon3 = (x + 1) / n * 360.0 - 180.0
-    lon4 = x / n * 360.0 - 180.0
-
+    lon = x / n * 360.0 - 180.0
     # latitude is more complex, Mercator is distorted because
     # it projects over a cylinder
     # there's a thing called "Gudermannian function" to calculate
     # this distortion, that's why there are sinh here
-    lat1 = atan(sinh(pi * (1 - 2 * y / n)))
-    lat1 = degrees(lat1)
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    return _unwrap(lat), _unwrap(lon)
+
 
-    lat2 = atan(sinh(pi * (1 - 2 * (y + 1) / n)))
-    lat2 = degrees(lat2)
+def tile_bounds(x, y, zoom: int) -> tuple:
+    """Bounds of tiles in degrees, as north, south, east, west"""
+    north, west = tile_to_deg(x, y, zoom)
+    south, east = tile_to_deg(np.asarray(x) + 1, np.asarray(y) + 1, zoom)
+    return north, south, east, west
 
-    lat3 = atan(sinh(pi * (1 - 2 * y / n)))
-    lat3 = degrees(lat3)
 
-    lat4 = atan(sinh(pi * (1 - 2 * (y + 1) / n)))
-    lat4 = degrees(lat4)
+def deg_to_tile(lat, lon, zoom: int) -> tuple:
+    """XYZ tile containing a point, Y grows going south like in Google maps"""
+    n = 2**zoom
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    x = np.floor((lon + 180.0) / 360.0 * n).astype(np.int64)
+    # inverse of the Gudermannian function used in tile_to_deg
+    y = np.floor((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n)
+    return _unwrap(x), _unwrap(y.astype(np.int64))
+
+
+def meters_to_tile(mx, my, zoom: int) -> tuple:
+    """XYZ tile containing a point in EPSG:3857"""
+    size = tile_size_meters(zoom)
+    mx = np.asarray(mx, dtype=np.float64)
+    my = np.asarray(my, dtype=np.float64)
+    return (
+        _unwrap(np.floor((mx + WEB_MERCATOR_EXTENT) / size).astype(np.int64)),
+        _unwrap(np.floor((WEB_MERCATOR_EXTENT - my) / size).astype(np.int64)),
+    )
 
-    north = max(lat1, lat2, lat3, lat4)
-    south = min(lat1, lat2, lat3, lat4)
-    east = max(lon1, lon2, lon3, lon4)
-    west = min(lon1, lon2, lon3, lon4)
 
-    return (north, south, east, west)
+def check_db(samples: int = 1000, seed: int = 0) -> float:
+    """Largest difference between tile_envelope and st_tileenvelope on random
+    tiles at every zoom level, in meters"""
+    from tiled_maps.database import open_connection
+
+    rng = np.random.default_rng(seed)
+    zooms = rng.integers(0, 21, samples)
+    xs = (rng.random(samples) * 2.0**zooms).astype(np.int64)
+    ys = (rng.random(samples) * 2.0**zooms).astype(np.int64)
+    with open_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT st_xmin(env), st_xmax(env), st_ymin(env), st_ymax(env)
+            FROM (
+                SELECT st_tileenvelope(z, x, y) AS env
+                FROM unnest(%(z)s::integer[], %(x)s::integer[], %(y)s::integer[])
+                    AS t(z, x, y)
+            ) envelopes
+            """,
+            dict(z=zooms.tolist(), x=xs.tolist(), y=ys.tolist()),
+        ).fetchall()
+    worst = 0.0
+    for z, x, y, expected in zip(zooms.tolist(), xs.tolist(), ys.tolist(), rows):
+        worst = max(
+            worst, *(abs(a - b) for a, b in zip(tile_envelope(x, y, z), expected))
+        )
+    return worst
 
 
 if __name__ == "__main__":
+    import sys
+
+    if "--check-db" in sys.argv:
+        print(f"Largest difference from PostGIS: {check_db()} meters")
+        sys.exit(0)
     # TMS coordinates of the La Scala opera house
     # note that they differ from Google ones since
     # the Y axis here grows going north, Google does the
@@ -1,67 +1,248 @@
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
 from os import environ
-from typing import Generator
-import json
+import time
+from typing import AsyncGenerator, Generator
 
 import psycopg
 from psycopg.types import TypeInfo
+from psycopg_pool import AsyncConnectionPool
 from psycopg.types.shapely import register_shapely
 from shapely.geometry import shape
 from shapely import prepare
 
+from tiled_maps.metrics import add_time, timed
+
 POSTGIS_CONN_STR = environ["POSTGIS_CONN_STR"]
+POSTGIS_POOL_MIN_SIZE = int(environ.get("POSTGIS_POOL_MIN_SIZE", "2"))
+POSTGIS_POOL_MAX_SIZE = int(environ.get("POSTGIS_POOL_MAX_SIZE", "8"))
+# seconds to wait for a free connection before failing
+POSTGIS_POOL_TIMEOUT = float(environ.get("POSTGIS_POOL_TIMEOUT", "30"))
+
+# tables of the pgosm-flex schema that are used to generate the maps
+FEATURE_TABLES = [
+    "building_polygon",
+    "road_line",
+    "water_polygon",
+    "landuse_polygon",
+    "natural_point",
+]
+
+_async_pool: AsyncConnectionPool | None = None
+
+
+def _configure(conn: psycopg.Connection) -> None:
+    info = TypeInfo.fetch(conn, "geometry")
+    register_shapely(info, conn)
+    # only reads here, avoid leaving transactions open in the pool
+    conn.commit()
+    conn.autocommit = True
+
+
+async def _configure_async(conn: psycopg.AsyncConnection) -> None:
+    info = await TypeInfo.fetch(conn, "geometry")
+    register_shapely(info, conn)
+    await conn.commit()
+    await conn.set_autocommit(True)
+
+
+def open_connection() -> psycopg.Connection:
+    """Open a connection with the geometry type mapped to shapely objects"""
+    conn = psycopg.connect(POSTGIS_CONN_STR)
+    _configure(conn)
+    return conn
+
+
+async def open_async_pool(
+    conninfo: str = POSTGIS_CONN_STR,
+    min_size: int = POSTGIS_POOL_MIN_SIZE,
+    max_size: int = POSTGIS_POOL_MAX_SIZE,
+) -> AsyncConnectionPool:
+    """Open the process-wide pool used by get_async_connection.
+
+    The geometry adapters are set up once per connection, and connections
+    are checked before being handed out so a DB restart does not break them.
+    Call it again with a different conninfo to point to another database.
+    """
+    global _async_pool
+    await close_async_pool()
+    _async_pool = AsyncConnectionPool(
+        conninfo,
+        min_size=min_size,
+        max_size=max_size,
+        timeout=POSTGIS_POOL_TIMEOUT,
+        configure=_configure_async,
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    await _async_pool.open()
+    return _async_pool
+
 
-@contextmanager
-def get_connection():
-    with psycopg.connect(POSTGIS_CONN_STR) as conn:
-        info = TypeInfo.fetch(conn, "geometry")
-        register_shapely(info, conn)
+async def close_async_pool() -> None:
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+def pool_stats() -> dict[str, int]:
+    """Counters of the pool, including requests_wait_ms and requests_queued"""
+    if _async_pool is not None:
+        return _async_pool.get_stats()
+    return {}
+
+
+@asynccontextmanager
+async def get_async_connection() -> AsyncGenerator[psycopg.AsyncConnection, None]:
+    if _async_pool is None:
+        await open_async_pool()
+    start = time.perf_counter()
+    async with _async_pool.connection() as conn:
+        add_time("pool_wait", time.perf_counter() - start)
         yield conn
 
 
-def retrieve_features(
-    x: int,
-    y: int,
-    z: int,
-    conn: psycopg.Connection,
-    swap_z: bool = False,
-    prepare_geometries: bool = False,
-) -> Generator[tuple[int, shape, dict], None, None]:
+def _tag_filter_clause(
+    tag_filter: list[tuple[str, list[str] | None]] | None,
+) -> tuple[str, dict]:
+    """SQL condition on the tags and its parameters, to fetch only these tags.
+
+    tag_filter is a list of tag keys with their accepted values, or None to
+    accept any value. Without a tag_filter nothing is filtered.
+    """
+    if tag_filter is None:
+        return "", {}
+    if len(tag_filter) == 0:
+        return "AND FALSE", {}
+    conditions = []
+    params = {}
+    for idx, (key, values) in enumerate(tag_filter):
+        params[f"tag_key_{idx}"] = key
+        if values is None:
+            conditions.append(f"tags.tags ? %(tag_key_{idx})s")
+        else:
+            params[f"tag_values_{idx}"] = list(values)
+            conditions.append(
+                f"tags.tags ->> %(tag_key_{idx})s = ANY(%(tag_values_{idx})s)"
+            )
+    return "AND (" + " OR ".join(conditions) + ")", params
+
+
+def _tags_expression(tag_keys: list[str] | None) -> tuple[str, dict]:
+    """SQL selecting only the given keys of the tags, and its parameters"""
+    if tag_keys is None:
+        return "tags.tags", {}
+    pairs = ", ".join(
+        f"%(tag_name_{idx})s::text, tags.tags -> %(tag_name_{idx})s::text"
+        for idx in range(len(tag_keys))
+    )
+    params = {f"tag_name_{idx}": key for idx, key in enumerate(tag_keys)}
+    # missing keys would be there as JSON nulls
+    return f"jsonb_strip_nulls(jsonb_build_object({pairs}))", params
+
+
+def _clip_expression(envelope: str) -> str:
+    """SQL of the geometry clipped to the envelope grown by a cell"""
+    return f"st_clipbybox2d(gdata.geom, st_expand({envelope}::box2d, %(cell_size)s))"
+
+
+def _geom_expression(envelope: str, cell_size: float | None) -> str:
+    """SQL of the geometry, clipped and simplified when cell_size is given.
+
+    The geometry is clipped to the envelope grown by a cell, and simplified
+    so that no point moves more than half a cell.
+    """
+    if cell_size is None:
+        return "gdata.geom"
+    return f"""st_simplifypreservetopology(
+                {_clip_expression(envelope)},
+                %(cell_size)s / 2
+            )"""
+
+
+def _not_empty_clause(envelope: str, cell_size: float | None) -> str:
+    """SQL condition dropping the features that clipping would leave empty.
+
+    The rows are selected by bbox overlap, a curved road can overlap the
+    envelope without getting within a cell of it.
+    """
+    if cell_size is None:
+        return ""
+    return f"AND NOT st_isempty({_clip_expression(envelope)})"
+
+
+def _features_query(
+    swap_z: bool,
+    tag_clause: str = "",
+    tags_expression: str = "tags.tags",
+    cell_size: float | None = None,
+) -> str:
     # depending on the service, tile Y is swapped
     y_clause = "%(y)s"
     if swap_z:
         y_clause = f"(2 ^ %(z)s - %(y)s)::integer"
-    tables = [
-        "building_polygon",
-        "road_line",
-        "water_polygon",
-        "landuse_polygon",
-        "natural_point",
-    ]
-
-    results = conn.execute(
-        """
+    envelope = f"st_tileenvelope(%(z)s, %(x)s, {y_clause})"
+    geom_expression = _geom_expression(envelope, cell_size)
+    empty_clause = _not_empty_clause(envelope, cell_size)
+    return """
     UNION ALL
     """.join(
-            [
-                f"""
+        [
+            f"""
         SELECT
             gdata.osm_id AS osm_id,
-            gdata.geom AS geom,
-            tags.tags AS tags
+            {geom_expression} AS geom,
+            {tags_expression} AS tags
         FROM
             osm.{tname} gdata
                 LEFT JOIN osm.tags tags ON tags.osm_id = ABS(gdata.osm_id)
         WHERE
-                geom &&
+                gdata.geom &&
                 st_tileenvelope(%(z)s, %(x)s, {y_clause})
+                {tag_clause}
+                {empty_clause}
         """
-                for tname in tables
-            ]
-        ),
-        dict(z=z, x=x, y=y),
+            for tname in FEATURE_TABLES
+        ]
     )
-    for row in results:
+
+
+def _features_query_params(
+    swap_z: bool,
+    tag_filter: list[tuple[str, list[str] | None]] | None,
+    tag_keys: list[str] | None,
+    cell_size: float | None,
+) -> tuple[str, dict]:
+    tag_clause, tag_params = _tag_filter_clause(tag_filter)
+    tags_expression, tags_params = _tags_expression(tag_keys)
+    query = _features_query(swap_z, tag_clause, tags_expression, cell_size)
+    return query, tag_params | tags_params | dict(cell_size=cell_size)
+
+
+def retrieve_features(
+    x: int,
+    y: int,
+    z: int,
+    conn: psycopg.Connection,
+    swap_z: bool = False,
+    prepare_geometries: bool = False,
+    tag_filter: list[tuple[str, list[str] | None]] | None = None,
+    tag_keys: list[str] | None = None,
+    cell_size: float | None = None,
+) -> Generator[tuple[int, shape, dict], None, None]:
+    """Features intersecting the tile.
+
+    The work done by PostGIS to reduce the transferred data is optional:
+    tag_filter returns only the features with these tags, tag_keys returns
+    only these keys of the tags, and cell_size clips and simplifies the
+    geometries to the resolution of the map.
+    """
+    query, params = _features_query_params(swap_z, tag_filter, tag_keys, cell_size)
+    with timed("fetch"):
+        results = conn.execute(query, params | dict(z=z, x=x, y=y))
+    with timed("decode"):
+        rows = results.fetchall()
+    for row in rows:
         osm_id, geom, tags = row
         # some test shows this brings no benefits here
         # probably each geometry is accessed only once and they are
@@ -71,27 +252,193 @@ def retrieve_features(
         yield osm_id, geom, tags
 
 
-def cell_bbox(
-    x: int, y: int, z: int, tiles: int, conn: psycopg.Connection, swap_z: bool = False
-) -> tuple[float, float, float, float]:
-    y_clause = "%(y)s"
+def retrieve_features_block(
+    min_x: int,
+    min_y: int,
+    max_x: int,
+    max_y: int,
+    z: int,
+    conn: psycopg.Connection,
+    swap_z: bool = False,
+    tag_filter: list[tuple[str, list[str] | None]] | None = None,
+    tag_keys: list[str] | None = None,
+    cell_size: float | None = None,
+) -> Generator[tuple[int, shape, dict, list[tuple[int, int]]], None, None]:
+    """Retrieve the features of a block of tiles, extremes included, at once.
+
+    Every feature is returned only once, together with the list of the
+    tiles of the block it intersects, using the same bbox overlap check of
+    retrieve_features so that splitting the result gives the same features.
+    The optional arguments are the ones of retrieve_features, clipping is
+    done on the whole block.
+    """
     # depending on the service, tile Y is swapped
+    y_clause = "ty"
     if swap_z:
-        y_clause = f"(2 ^ %(z)s - %(y)s)::integer"
-    extent = json.loads(
-        conn.execute(
+        y_clause = f"(2 ^ %(z)s - ty)::integer"
+    tag_clause, tag_params = _tag_filter_clause(tag_filter)
+    tags_expression, tags_params = _tags_expression(tag_keys)
+    geom_expression = _geom_expression("block_extent.env", cell_size)
+    empty_clause = _not_empty_clause("block_extent.env", cell_size)
+    features_query = """
+    UNION ALL
+    """.join(
+        [
             f"""
-        select st_asgeojson(st_tileenvelope(%(z)s, %(x)s, {y_clause}))
-        """,
-            dict(z=z, x=x, y=y),
-        ).fetchone()[0]
+        SELECT
+            gdata.osm_id AS osm_id,
+            {geom_expression} AS geom,
+            {tags_expression} AS tags
+        FROM
+            osm.{tname} gdata
+                LEFT JOIN osm.tags tags ON tags.osm_id = ABS(gdata.osm_id),
+            block_extent
+        WHERE
+                gdata.geom && block_extent.env
+                {tag_clause}
+                {empty_clause}
+        """
+            for tname in FEATURE_TABLES
+        ]
+    )
+    query = f"""
+        WITH block AS (
+            SELECT
+                tx,
+                ty,
+                st_tileenvelope(%(z)s, tx, {y_clause}) AS env
+            FROM
+                generate_series(%(min_x)s::integer, %(max_x)s::integer) tx,
+                generate_series(%(min_y)s::integer, %(max_y)s::integer) ty
+        ),
+        block_extent AS (
+            SELECT st_setsrid(st_extent(env)::geometry, 3857) AS env FROM block
+        ),
+        features AS ({features_query})
+        SELECT
+            f.osm_id,
+            f.geom,
+            f.tags,
+            ARRAY(SELECT ARRAY[b.tx, b.ty] FROM block b WHERE b.env && f.geom)
+        FROM features f
+        """
+    params = (
+        dict(z=z, min_x=min_x, min_y=min_y, max_x=max_x, max_y=max_y)
+        | tag_params
+        | tags_params
+        | dict(cell_size=cell_size)
+    )
+    with timed("fetch"):
+        results = conn.execute(query, params)
+    with timed("decode"):
+        rows = results.fetchall()
+    for osm_id, geom, tags, tiles in rows:
+        yield osm_id, geom, tags, [(tx, ty) for tx, ty in tiles]
+
+
+def feature_extents(
+    osm_ids: list[int], conn: psycopg.Connection
+) -> list[tuple[float, float, float, float]]:
+    """Bounds in EPSG:3857, as min_x, min_y, max_x, max_y, of the current
+    geometries with the given ids, ids not in the DB are ignored"""
+    query = """
+    UNION ALL
+    """.join(
+        f"""
+        SELECT st_xmin(geom), st_ymin(geom), st_xmax(geom), st_ymax(geom)
+        FROM osm.{tname}
+        WHERE osm_id = ANY(%(osm_ids)s)
+        """
+        for tname in FEATURE_TABLES
+    )
+    return [tuple(row) for row in conn.execute(query, dict(osm_ids=osm_ids))]
+
+
+def feature_ids_in_bbox(
+    west: float, south: float, east: float, north: float, conn: psycopg.Connection
+) -> list[int]:
+    """Ids of the features intersecting a bbox in degrees"""
+    query = """
+    UNION
+    """.join(
+        f"""
+        SELECT osm_id
+        FROM osm.{tname}
+        WHERE geom && st_transform(
+            st_makeenvelope(%(west)s, %(south)s, %(east)s, %(north)s, 4326), 3857
+        )
+        """
+        for tname in FEATURE_TABLES
     )
-    # must be EPSG 3857
-    assert extent["crs"]["properties"]["name"] == "EPSG:3857"
-    # last coordinate is repeated
-    coords = [tuple(t) for t in extent["coordinates"][0][:3]]
-    min_x = min(x for (x, _) in coords)
-    max_x = max(x for (x, _) in coords)
-    min_y = min(y for (_, y) in coords)
-    max_y = max(y for (_, y) in coords)
-    return (min_x, max_x, min_y, max_y)
+    params = dict(west=west, south=south, east=east, north=north)
+    return [osm_id for (osm_id,) in conn.execute(query, params)]
+
+
+def retrieve_mvt(
+    x: int,
+    y: int,
+    z: int,
+    conn: psycopg.Connection,
+    layer: str,
+    extent: int = 4096,
+    buffer: int = 64,
+    tag_filter: list[tuple[str, list[str] | None]] | None = None,
+    tag_keys: list[str] | None = None,
+) -> bytes:
+    """The features of a tile as a Mapbox vector tile, in a single layer.
+
+    Every feature has its osm_id and its tags as properties. tag_filter and
+    tag_keys are the ones of retrieve_features.
+    """
+    tag_clause, tag_params = _tag_filter_clause(tag_filter)
+    tags_expression, tags_params = _tags_expression(tag_keys)
+    features_query = """
+    UNION ALL
+    """.join(
+        f"""
+        SELECT
+            gdata.osm_id AS osm_id,
+            st_asmvtgeom(
+                gdata.geom, st_tileenvelope(%(z)s, %(x)s, %(y)s)::box2d,
+                %(extent)s, %(buffer)s, true
+            ) AS geom,
+            {tags_expression} AS tags
+        FROM
+            osm.{tname} gdata
+                LEFT JOIN osm.tags tags ON tags.osm_id = ABS(gdata.osm_id)
+        WHERE
+                gdata.geom && st_tileenvelope(%(z)s, %(x)s, %(y)s)
+                {tag_clause}
+        """
+        for tname in FEATURE_TABLES
+    )
+    # the jsonb tags become properties of the features
+    query = f"""
+        SELECT st_asmvt(features.*, %(layer)s, %(extent)s, 'geom')
+        FROM ({features_query}) features
+        WHERE features.geom IS NOT NULL
+    """
+    params = tag_params | tags_params | dict(z=z, x=x, y=y)
+    params |= dict(extent=extent, buffer=buffer, layer=layer)
+    with timed("fetch"):
+        (tile,) = conn.execute(query, params).fetchone()
+    return bytes(tile or b"")
+
+
+async def retrieve_features_async(
+    x: int,
+    y: int,
+    z: int,
+    conn: psycopg.AsyncConnection,
+    swap_z: bool = False,
+    tag_filter: list[tuple[str, list[str] | None]] | None = None,
+    tag_keys: list[str] | None = None,
+    cell_size: float | None = None,
+) -> list[tuple[int, shape, dict]]:
+    """Same as retrieve_features, using an asyncio connection"""
+    query, params = _features_query_params(swap_z, tag_filter, tag_keys, cell_size)
+    with timed("fetch"):
+        cur = await conn.execute(query, params | dict(z=z, x=x, y=y))
+    with timed("decode"):
+        rows = await cur.fetchall()
+    return [(osm_id, geom, tags) for osm_id, geom, tags in rows]
@@ -0,0 +1,67 @@
+"""Persisted index of the OSM features drawn in each generated chunk.
+
+It is a SQLite file, at FEATURE_INDEX_PATH, updated every time a chunk is
+saved and used to find the chunks to regenerate when some features change.
+"""
+
+from pathlib import Path
+import sqlite3
+from typing import Iterable
+
+# SQLite limits the number of parameters of a query
+_BATCH_SIZE = 500
+
+
+def open_index(path: Path) -> sqlite3.Connection:
+    # many processes write here, wait for the others instead of failing
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS feature_chunk (
+            osm_id INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            PRIMARY KEY (osm_id, x, y)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS feature_chunk_xy ON feature_chunk (x, y)")
+    return conn
+
+
+def record_chunk(path: Path, x: int, y: int, osm_ids: Iterable[int]) -> None:
+    """Replace the features of a chunk"""
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM feature_chunk WHERE x = ? AND y = ?", (x, y))
+            conn.executemany(
+                "INSERT INTO feature_chunk (osm_id, x, y) VALUES (?, ?, ?)",
+                [(osm_id, x, y) for osm_id in set(osm_ids)],
+            )
+    finally:
+        conn.close()
+
+
+def chunks_of_features(path: Path, osm_ids: Iterable[int]) -> set[tuple[int, int]]:
+    """Chunks where any of the features was drawn when they were generated"""
+    if not path.exists():
+        return set()
+    ids = list(set(osm_ids))
+    ret = set()
+    conn = open_index(path)
+    try:
+        for start in range(0, len(ids), _BATCH_SIZE):
+            batch = ids[start : start + _BATCH_SIZE]
+            placeholders = ", ".join("?" for _ in batch)
+            ret.update(
+                conn.execute(
+                    "SELECT DISTINCT x, y FROM feature_chunk "
+                    f"WHERE osm_id IN ({placeholders})",
+                    batch,
+                ).fetchall()
+            )
+    finally:
+        conn.close()
+    return ret
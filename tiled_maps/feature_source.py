@@ -0,0 +1,342 @@
+"""Where the features drawn in the maps come from.
+
+PostGISSource queries the database, MBTilesSource reads vector tiles from
+a local MBTiles file built once from the database, so that chunks can be
+generated where there is no database:
+
+    python -m tiled_maps.feature_source --build world.mbtiles --chunks -10 -10 10 10
+
+and then FEATURES_MBTILES=world.mbtiles for pregenerate and the HTTP app.
+Reading vector tiles needs the mvt extra, mapbox-vector-tile.
+"""
+
+from dataclasses import dataclass, field
+import gzip
+from os import environ
+from pathlib import Path
+import sqlite3
+from typing import TYPE_CHECKING, Iterable, Protocol
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from tiled_maps.coordinates import tile_envelope
+from tiled_maps.metrics import timed
+
+# the database module needs POSTGIS_CONN_STR, it's imported only to use PostGIS
+if TYPE_CHECKING:
+    import psycopg
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+# set to an MBTiles file to generate the chunks from it instead of PostGIS
+FEATURES_MBTILES = (
+    Path(environ["FEATURES_MBTILES"]) if environ.get("FEATURES_MBTILES") else None
+)
+
+# name of the layer with the features in the vector tiles
+MVT_LAYER = "features"
+
+Feature = tuple[int, shape, dict]
+TagFilter = list[tuple[str, list[str] | None]] | None
+
+
+class FeatureSource(Protocol):
+    """The arguments after z are the ones of database.retrieve_features,
+    sources can ignore them, the rules are applied to the features anyway"""
+
+    def features(
+        self,
+        x: int,
+        y: int,
+        z: int,
+        tag_filter: TagFilter = None,
+        tag_keys: list[str] | None = None,
+        cell_size: float | None = None,
+    ) -> Iterable[Feature]:
+        """Features intersecting a tile"""
+        ...
+
+    def features_block(
+        self,
+        min_x: int,
+        min_y: int,
+        max_x: int,
+        max_y: int,
+        z: int,
+        tag_filter: TagFilter = None,
+        tag_keys: list[str] | None = None,
+        cell_size: float | None = None,
+    ) -> Iterable[tuple[int, shape, dict, list[tuple[int, int]]]]:
+        """Features of a block of tiles, extremes included, with the tiles
+        each one intersects, like database.retrieve_features_block"""
+        ...
+
+
+@dataclass
+class PostGISSource:
+    conn: "psycopg.Connection"
+
+    def features(self, x, y, z, tag_filter=None, tag_keys=None, cell_size=None):
+        from tiled_maps.database import retrieve_features
+
+        return retrieve_features(
+            x,
+            y,
+            z,
+            self.conn,
+            tag_filter=tag_filter,
+            tag_keys=tag_keys,
+            cell_size=cell_size,
+        )
+
+    def features_block(
+        self,
+        min_x,
+        min_y,
+        max_x,
+        max_y,
+        z,
+        tag_filter=None,
+        tag_keys=None,
+        cell_size=None,
+    ):
+        from tiled_maps.database import retrieve_features_block
+
+        return retrieve_features_block(
+            min_x,
+            min_y,
+            max_x,
+            max_y,
+            z,
+            self.conn,
+            tag_filter=tag_filter,
+            tag_keys=tag_keys,
+            cell_size=cell_size,
+        )
+
+
+def decode_mvt(data: bytes, x: int, y: int, z: int) -> list[Feature]:
+    """Features of a vector tile, with the geometries in EPSG:3857"""
+    if mapbox_vector_tile is None:
+        raise RuntimeError(
+            "Reading vector tiles requires the mapbox-vector-tile package"
+        )
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    layer = mapbox_vector_tile.decode(
+        data, default_options=dict(y_coord_down=True)
+    ).get(MVT_LAYER)
+    if layer is None:
+        return []
+    min_x, max_x, min_y, max_y = tile_envelope(x, y, z)
+    # tile coordinates grow going east and south from the north west corner
+    scale = np.array(
+        [(max_x - min_x) / layer["extent"], -(max_y - min_y) / layer["extent"]]
+    )
+    origin = np.array([min_x, max_y])
+    ret = []
+    for feat in layer["features"]:
+        tags = dict(feat["properties"])
+        osm_id = tags.pop("osm_id", feat.get("id"))
+        geom = shapely.transform(
+            shape(feat["geometry"]), lambda coords: coords * scale + origin
+        )
+        ret.append((osm_id, geom, tags))
+    return ret
+
+
+@dataclass
+class MBTilesSource:
+    """Vector tiles of a single zoom level in an MBTiles file.
+
+    Tiles at other zooms get the features of the stored tiles covering them,
+    a feature crossing stored tiles comes once for each of them, clipped.
+    """
+
+    path: Path
+    # the zoom of the stored tiles, from the metadata
+    zoom: int = field(init=False)
+
+    def __post_init__(self):
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            (value,) = conn.execute(
+                "SELECT value FROM metadata WHERE name = 'maxzoom'"
+            ).fetchone()
+        finally:
+            conn.close()
+        self.zoom = int(value)
+
+    def _read(self, tiles: list[tuple[int, int]], z: int) -> list[Feature]:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            ret = []
+            for x, y in tiles:
+                with timed("fetch"):
+                    # MBTiles rows follow the TMS convention, Y grows north
+                    row = conn.execute(
+                        "SELECT tile_data FROM tiles "
+                        "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                        (z, x, 2**z - 1 - y),
+                    ).fetchone()
+                if row is not None:
+                    with timed("decode"):
+                        ret.extend(decode_mvt(row[0], x, y, z))
+            return ret
+        finally:
+            conn.close()
+
+    def features(self, x, y, z, tag_filter=None, tag_keys=None, cell_size=None):
+        stored_z = self.zoom
+        if z >= stored_z:
+            shift = z - stored_z
+            return self._read([(x >> shift, y >> shift)], stored_z)
+        # every stored tile inside this one
+        side = 2 ** (stored_z - z)
+        return self._read(
+            [
+                (sx, sy)
+                for sy in range(y * side, (y + 1) * side)
+                for sx in range(x * side, (x + 1) * side)
+            ],
+            stored_z,
+        )
+
+    def features_block(
+        self,
+        min_x,
+        min_y,
+        max_x,
+        max_y,
+        z,
+        tag_filter=None,
+        tag_keys=None,
+        cell_size=None,
+    ):
+        for y in range(min_y, max_y + 1):
+            for x in range(min_x, max_x + 1):
+                for osm_id, geom, tags in self.features(x, y, z):
+                    yield osm_id, geom, tags, [(x, y)]
+
+
+def open_source() -> FeatureSource:
+    """The MBTiles source when FEATURES_MBTILES is set, otherwise PostGIS"""
+    if FEATURES_MBTILES is not None:
+        return MBTilesSource(FEATURES_MBTILES)
+    from tiled_maps.database import open_connection
+
+    return PostGISSource(open_connection())
+
+
+def build_mbtiles(
+    path: Path,
+    tiles: Iterable[tuple[int, int]],
+    z: int,
+    conn: "psycopg.Connection",
+    tag_filter: TagFilter = None,
+    tag_keys: list[str] | None = None,
+) -> int:
+    """Store the vector tiles of the given tiles from PostGIS, returns how many.
+
+    Tiles already in the file are replaced.
+    """
+    from tiled_maps.database import retrieve_mvt
+
+    out = sqlite3.connect(path)
+    try:
+        out.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+        out.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                tile_data BLOB
+            )
+            """
+        )
+        out.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+            "ON tiles (zoom_level, tile_column, tile_row)"
+        )
+        stored = out.execute(
+            "SELECT value FROM metadata WHERE name = 'maxzoom'"
+        ).fetchone()
+        if stored is not None and int(stored[0]) != z:
+            raise ValueError(f"{path} has tiles of zoom {stored[0]}, not {z}")
+        with out:
+            out.execute("DELETE FROM metadata")
+            out.executemany(
+                "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                [
+                    ("name", path.stem),
+                    ("format", "pbf"),
+                    ("minzoom", str(z)),
+                    ("maxzoom", str(z)),
+                ],
+            )
+        done = 0
+        for x, y in tiles:
+            tile = retrieve_mvt(
+                x, y, z, conn, MVT_LAYER, tag_filter=tag_filter, tag_keys=tag_keys
+            )
+            with out:
+                out.execute(
+                    "INSERT OR REPLACE INTO tiles "
+                    "(zoom_level, tile_column, tile_row, tile_data) "
+                    "VALUES (?, ?, ?, ?)",
+                    (z, x, 2**z - 1 - y, gzip.compress(tile)),
+                )
+            done += 1
+        return done
+    finally:
+        out.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from tiled_maps.chunks import GAME_ZOOM_LEVEL, chunk_to_tile
+    from tiled_maps.database import open_connection
+    from tiled_maps.tilegen.rules import get_tag_filter, get_tag_keys
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--build", type=Path, required=True, help="MBTiles file to create or update"
+    )
+    parser.add_argument(
+        "--chunks",
+        nargs=4,
+        type=int,
+        required=True,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="rectangle of chunk coordinates, extremes included",
+    )
+    parser.add_argument(
+        "--rules-only",
+        action="store_true",
+        help="store only the features and tags used by the current rules",
+    )
+    args = parser.parse_args()
+    min_x, min_y, max_x, max_y = args.chunks
+    options = {}
+    if args.rules_only:
+        options = dict(tag_filter=get_tag_filter(), tag_keys=get_tag_keys())
+    with open_connection() as conn:
+        done = build_mbtiles(
+            args.build,
+            [
+                chunk_to_tile(x, y)
+                for y in range(min_y, max_y + 1)
+                for x in range(min_x, max_x + 1)
+            ],
+            GAME_ZOOM_LEVEL,
+            conn,
+            **options,
+        )
+    print(f"Stored {done} tiles of zoom {GAME_ZOOM_LEVEL} in {args.build}")
@@ -1,32 +1,142 @@
-from io import BytesIO
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import contextvars
 import json
 from pathlib import Path
-import mimetypes
 import re
 from os import environ
+import time
+from typing import Callable, TypeVar
 
-from tiled_maps.database import get_connection
-from tiled_maps.raster import render_tilemap
+from tiled_maps.chunks import (
+    BASE_FOLDER,
+    GAME_ZOOM_LEVEL,
+    GENERATED_FOLDER,
+    TILE_RESOLUTION,
+    WORLD_STORE_PATH,
+    chunk_exists,
+    chunk_path,
+    chunk_to_tile,
+    lock_chunk,
+    save_chunk,
+    stored_chunk_json,
+    tile_to_chunk,
+    unlock_chunk,
+)
+from tiled_maps.coordinates import tile_envelope
+from tiled_maps.feature_source import FEATURES_MBTILES, MBTilesSource
+from tiled_maps import metrics, pyramid
+from tiled_maps.raster import render_png
+from tiled_maps.static_files import static_response
+from tiled_maps.tile_cache import CachedTile, TileCache, make_etag
 from tiled_maps.tilegen import generate
+from tiled_maps import world_store
 
 
-from fastapi import FastAPI, HTTPException
-from fastapi import Depends
-from fastapi.responses import Response
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the database module needs POSTGIS_CONN_STR, with MBTiles there is no pool
+    if mbtiles_source is None:
+        from tiled_maps.database import open_async_pool
 
-CHUNK_REGEX = re.compile(r".+chunk_(-?\d+)_(-?\d+).json")
-WORLD_CENTER_X = int(environ["WORLD_CENTER_X"])
-WORLD_CENTER_Y = int(environ["WORLD_CENTER_Y"])
-GAME_ZOOM_LEVEL = int(environ["GAME_ZOOM_LEVEL"])
-TILE_RESOLUTION = int(environ["TILE_RESOLUTION"])
+        await open_async_pool()
+    yield
+    if mbtiles_source is None:
+        from tiled_maps.database import close_async_pool
+
+        await close_async_pool()
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+CHUNK_REGEX = re.compile(r".+/chunk_(-?\d+)_(-?\d+)\.json")
+EVENT_FILE_REGEX = re.compile(r".+/(chunk_(-?\d+)_(-?\d+)_[^/]+\.json)")
 CELL_PIXEL_SIZE = int(environ["CELL_PIXEL_SIZE"])
+# threads used by each server worker for map generation and rendering
+GENERATION_THREADS = int(environ.get("GENERATION_THREADS", "4"))
+# for the static files like tilesets and spritesheets
+STATIC_CACHE_CONTROL = environ.get("STATIC_CACHE_CONTROL", "public, max-age=3600")
+# set to 1 to add a Server-Timing header with the time of each generation stage
+SERVER_TIMING = environ.get("SERVER_TIMING", "0") == "1"
+
+# generation and rendering are CPU-bound and must not block the event loop,
+# shapely and Pillow release the GIL for most of their work so threads are
+# enough, and with multiple uvicorn workers all the cores are used anyway
+cpu_executor = ThreadPoolExecutor(max_workers=GENERATION_THREADS)
+# chunks being generated by this worker, so that concurrent requests for the
+# same chunk wait for the same generation
+chunks_in_progress: dict[tuple[int, int], asyncio.Future] = {}
+# the same for the pyramid tiles, by cache key
+pyramid_in_progress: dict[str, asyncio.Future] = {}
+tile_cache = TileCache()
+# read by the generation threads, each read uses its own SQLite connection
+mbtiles_source = (
+    MBTilesSource(FEATURES_MBTILES) if FEATURES_MBTILES is not None else None
+)
+
+T = TypeVar("T")
+
+
+async def run_cpu(fn: Callable[..., T], *args) -> T:
+    # the context carries the timings of the request to the thread
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        cpu_executor, ctx.run, fn, *args
+    )
+
+
+async def get_cached_tile(key: str) -> CachedTile | None:
+    tile = tile_cache.get_memory(key)
+    if tile is None:
+        # reading a file is not CPU work, don't take the generation threads for it
+        tile = await asyncio.to_thread(tile_cache.get, key)
+    return tile
+
+
+async def fetch_features(x: int, y: int, z: int) -> list:
+    """Features of a tile, from the MBTiles file when configured"""
+    options = generate.fetch_options(z, TILE_RESOLUTION)
+    if mbtiles_source is not None:
+        # reading and decoding the local file is CPU work
+        return await run_cpu(lambda: list(mbtiles_source.features(x, y, z, **options)))
+    from tiled_maps.database import get_async_connection, retrieve_features_async
+
+    async with get_async_connection() as conn:
+        return await retrieve_features_async(x, y, z, conn, **options)
+
+
+def database_pool_stats() -> dict[str, int]:
+    """Counters of the database pool, none when reading MBTiles"""
+    if mbtiles_source is not None:
+        return {}
+    from tiled_maps.database import pool_stats
+
+    return pool_stats()
+
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    if not SERVER_TIMING:
+        return await call_next(request)
+    timings: dict[str, float] = {}
+    token = metrics.request_timings.set(timings)
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_timings.reset(token)
+    if len(timings) > 0:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
 
 
 @app.get("/maps/generated/world.world")
-def get_world_file():
+async def get_world_file():
     game_world_data = {
         "patterns": [
             {
@@ -44,65 +154,227 @@ def get_world_file():
     return game_world_data
 
 
-@app.get("/zxy_gamified/{z}/{x}/{y}.{ext}")
-def generate_raster_tile(
-    z: int, x: int, y: int, ext: str, conn=Depends(get_connection)
-):
-    import time
+@app.get("/stats/pool")
+async def get_pool_stats():
+    return database_pool_stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage timings and counters of this worker, in Prometheus text format"""
+    gauges = {f"pool_{k}": v for k, v in database_pool_stats().items()}
+    return PlainTextResponse(
+        metrics.render(gauges), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.post("/zxy_gamified/invalidate")
+async def invalidate_raster_tiles():
+    await run_cpu(tile_cache.invalidate)
+    return {"version": tile_cache.version()}
+
+
+def cached_tile_response(
+    tile: CachedTile, request: Request, media_type: str
+) -> Response:
+    headers = {
+        "ETag": tile.etag,
+        "Last-Modified": tile.last_modified_header(),
+        "Cache-Control": "no-cache",
+    }
+    if tile.matches(
+        request.headers.get("if-none-match"), request.headers.get("if-modified-since")
+    ):
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile.content, media_type=media_type, headers=headers)
 
-    start = time.time()
+
+@app.get("/zxy_gamified/{z}/{x}/{y}.{ext}")
+async def generate_raster_tile(z: int, x: int, y: int, ext: str, request: Request):
+    if ext not in ("json", "png"):
+        raise HTTPException(400, f"Unknown extension {ext}")
+    media_type = "application/json" if ext == "json" else "image/png"
+    if not pyramid.in_zoom_range(z):
+        if ext == "json":
+            raise HTTPException(404, f"Zoom {z} is not served")
+        return Response(content=pyramid.empty_png(), media_type=media_type)
+    if ext == "png" and pyramid.from_pyramid(z):
+        tile = await get_or_build_pyramid_tile(z, x, y)
+        return cached_tile_response(tile, request, media_type)
+    key = f"{z}/{x}/{y}.{ext}"
+    tile = await get_cached_tile(key)
+    if tile is not None:
+        metrics.increment("raster_cache_hits")
+        return cached_tile_response(tile, request, media_type)
+    metrics.increment("raster_cache_misses")
+    bbox = tile_envelope(x, y, z)
+    features = await fetch_features(x, y, z)
     # path is fake, this is not going to be persisted
-    tm = generate.generate_map(Path("/fake"), x, y, z, conn, tiles=TILE_RESOLUTION)
-    print(f"Time for pure generation: {time.time() - start:.2f}")
-    data_repr = tm.to_dict()
+    tm = await run_cpu(
+        generate.build_map, Path("/fake"), features, bbox, TILE_RESOLUTION
+    )
 
     if ext == "json":
-        return data_repr
-    elif ext == "png":
-        out_image = render_tilemap(tm)
-        ret_data = BytesIO()
-        out_image.save(ret_data, "PNG")
-        return Response(content=ret_data.getvalue(), media_type="image/png")
+        with metrics.timed("serialize"):
+            content = tm.to_json_bytes()
+    else:
+        content = await run_cpu(render_png, tm)
+    tile = await asyncio.to_thread(tile_cache.put, key, content)
+    return cached_tile_response(tile, request, media_type)
+
+
+async def build_pyramid_tile(z: int, x: int, y: int) -> CachedTile:
+    key = pyramid.tile_key(z, x, y)
+    tile = await get_cached_tile(key)
+    if tile is not None:
+        metrics.increment("raster_cache_hits")
+        return tile
+    metrics.increment("raster_cache_misses")
+    if z == GAME_ZOOM_LEVEL:
+        chunk = tile_to_chunk(x, y)
+        if not await asyncio.to_thread(chunk_exists, *chunk):
+            await get_or_generate_chunk(*chunk)
+        content = await run_cpu(pyramid.render_chunk_tile, x, y)
+    elif pyramid.builds_missing(z):
+        tiles = await asyncio.gather(
+            *(
+                get_or_build_pyramid_tile(z + 1, cx, cy)
+                for cx, cy in pyramid.children(x, y)
+            )
+        )
+        content = await run_cpu(
+            pyramid.merge_children, [child.content for child in tiles]
+        )
     else:
-        return HTTPException(400, f"Unknown extension {ext}")
+        # too many chunks to generate for a request, use what is there
+        tiles = [
+            await get_cached_tile(pyramid.tile_key(z + 1, cx, cy))
+            for cx, cy in pyramid.children(x, y)
+        ]
+        pngs = [pyramid.empty_png() if t is None else t.content for t in tiles]
+        content = await run_cpu(pyramid.merge_children, pngs)
+        if any(t is None for t in tiles):
+            # not cached, it is built again when the missing children are there
+            return CachedTile(content, make_etag(content), time.time())
+    return await asyncio.to_thread(tile_cache.put, key, content)
+
+
+async def get_or_build_pyramid_tile(z: int, x: int, y: int) -> CachedTile:
+    key = pyramid.tile_key(z, x, y)
+    task = pyramid_in_progress.get(key)
+    if task is None:
+        task = asyncio.ensure_future(build_pyramid_tile(z, x, y))
+        pyramid_in_progress[key] = task
+        task.add_done_callback(lambda _: pyramid_in_progress.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def generate_chunk(x: int, y: int) -> bytes:
+    """Generate a chunk and persist it, returns its Tiled JSON.
+
+    Other workers and pregenerate runs can be generating the same chunk, the
+    chunk lock makes sure only one of them does it, the others wait and read
+    the result.
+    """
+    p = chunk_path(x, y)
+    # waiting is not CPU work, don't take the generation threads for it
+    lock_file = await asyncio.to_thread(lock_chunk, x, y)
+    try:
+        if WORLD_STORE_PATH is not None and await asyncio.to_thread(chunk_exists, x, y):
+            return (await run_cpu(stored_chunk_json, x, y))[0]
+        if p.is_file():
+            return await asyncio.to_thread(p.read_bytes)
+        return await generate_chunk_locked(x, y)
+    finally:
+        unlock_chunk(lock_file)
+
+
+async def generate_chunk_locked(x: int, y: int) -> bytes:
+    """Same as generate_chunk, the caller must hold the chunk lock"""
+    p = chunk_path(x, y)
+    geo_x, geo_y = chunk_to_tile(x, y)
+    print(f"Chunk {x, y} means XYZ {geo_x, geo_y, GAME_ZOOM_LEVEL}")
+    bbox = tile_envelope(geo_x, geo_y, GAME_ZOOM_LEVEL)
+    features = await fetch_features(geo_x, geo_y, GAME_ZOOM_LEVEL)
+
+    def build_and_save() -> bytes:
+        tm = generate.build_map(p, features, bbox, TILE_RESOLUTION)
+        # cache the file
+        return save_chunk(tm, x, y)
+
+    return await run_cpu(build_and_save)
+
+
+async def get_or_generate_chunk(x: int, y: int) -> bytes:
+    task = chunks_in_progress.get((x, y))
+    if task is None:
+        task = asyncio.ensure_future(generate_chunk(x, y))
+        chunks_in_progress[(x, y)] = task
+        task.add_done_callback(lambda _: chunks_in_progress.pop((x, y), None))
+    # a client going away must not cancel the generation for the others
+    return await asyncio.shield(task)
+
+
+async def stored_chunk_response(x: int, y: int, if_none_match: str | None):
+    """A chunk from the world store, its Tiled JSON is built only here"""
+    version = await asyncio.to_thread(world_store.chunk_version, WORLD_STORE_PATH, x, y)
+    headers = {"ETag": f'"chunk_{x}_{y}_{version}"', "Cache-Control": "no-cache"}
+    if if_none_match is not None and headers["ETag"] in [
+        t.strip() for t in if_none_match.split(",")
+    ]:
+        return Response(status_code=304, headers=headers)
+    # a regeneration can happen meanwhile, the ETag must be of what is sent
+    content, version = await run_cpu(stored_chunk_json, x, y)
+    headers["ETag"] = f'"chunk_{x}_{y}_{version}"'
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @app.get("/{file_path:path}")
-def get_path(file_path: str):
-    base_folder = Path("demo_tilegame2")
-    p = base_folder / file_path
-    assert p.is_relative_to(base_folder)
-    if p.exists() and not p.is_dir():
-        raw_data = p.read_bytes()
-        return Response(content=raw_data, media_type=mimetypes.guess_type(file_path)[0])
+async def get_path(file_path: str, request: Request):
+    p = BASE_FOLDER / file_path
+    assert p.is_relative_to(BASE_FOLDER)
+    accept_encoding = request.headers.get("accept-encoding")
+    if_none_match = request.headers.get("if-none-match")
+    chunk_match = CHUNK_REGEX.fullmatch(file_path)
+    event_match = EVENT_FILE_REGEX.fullmatch(file_path)
+    # with the world store, exported chunk files can be outdated
+    in_store = WORLD_STORE_PATH is not None and (
+        event_match is not None or chunk_match is not None
+    )
+    if p.is_file() and not in_store:
+        if chunk_match is not None:
+            metrics.increment("chunk_cache_hits")
+        # chunks can be regenerated, clients must always check the ETag
+        cache_control = (
+            "no-cache" if p.is_relative_to(GENERATED_FOLDER) else STATIC_CACHE_CONTROL
+        )
+        return static_response(p, accept_encoding, if_none_match, cache_control)
+    if in_store and event_match is not None:
+        event_path, x, y = event_match.groups()
+        content = await asyncio.to_thread(
+            world_store.event_file, WORLD_STORE_PATH, int(x), int(y), event_path
+        )
+        if content is None:
+            raise HTTPException(404, "File not found")
+        return Response(
+            content=content,
+            media_type="application/json",
+            headers={"Cache-Control": "no-cache"},
+        )
     # not there, was it a chunk request?
-    if CHUNK_REGEX.match(file_path) is None:
+    if chunk_match is None:
         print("Cannot find ", p)
         raise HTTPException(404, "File not found")
     # it was, generate it on the fly
     # get the tiled world coordinates
-    x, y = (int(e) for e in CHUNK_REGEX.match(file_path).groups())
-    geo_x = WORLD_CENTER_X + x
-    geo_y = WORLD_CENTER_Y + y
-    p = base_folder / f"maps/generated/chunk_{x}_{y}.json"
-    # if already there, read it and that's it
-    if p.exists():
-        with open(p) as fr:
-            return json.load(fr)
-    print(f"Chunk {y, y} means XYZ {geo_x, geo_y, GAME_ZOOM_LEVEL}")
-    import time
-
-    start = time.time()
-    with get_connection() as conn:
-        tm = generate.generate_map(
-            p, geo_x, geo_y, GAME_ZOOM_LEVEL, conn, tiles=TILE_RESOLUTION
-        )
-    print(f"Time for pure generation: {time.time() - start:.2f}")
-    # cache the file
-    data_repr = tm.to_dict()
-    with open(p, "w") as fw:
-        json.dump(data_repr, fw)
-    for relpath, content in tm.get_event_files():
-        with open(p.parent / relpath, "w") as fw:
-            fw.write(content)
-    return data_repr
+    x, y = (int(e) for e in chunk_match.groups())
+    p = chunk_path(x, y)
+    # if not there yet generate it, it is then served like any other file
+    if not await asyncio.to_thread(chunk_exists, x, y):
+        metrics.increment("chunk_cache_misses")
+        await get_or_generate_chunk(x, y)
+    else:
+        metrics.increment("chunk_cache_hits")
+    if WORLD_STORE_PATH is not None:
+        return await stored_chunk_response(x, y, if_none_match)
+    return static_response(p, accept_encoding, if_none_match, "no-cache")
@@ -0,0 +1,95 @@
+"""Time spent in each stage of map generation, and counters, for monitoring.
+
+Values are kept per process, every uvicorn worker exposes its own at
+/metrics in the Prometheus text format. The timings of a single request
+are also collected when request_timings is set, for the Server-Timing header.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+from typing import Generator
+
+# the stages are pool_wait, fetch (the query), decode (reading the rows and
+# the geometries), classify, rasterize, merge (writing the layers), serialize,
+# write, compress, render and png_encode
+
+COUNTERS = {
+    "features_fetched": "features received from the database",
+    "features_drawn": "features matching a rule and drawn in a map",
+    "raster_cache_hits": "raster tiles served from the cache",
+    "raster_cache_misses": "raster tiles generated",
+    "chunk_cache_hits": "chunks already on disk when requested",
+    "chunk_cache_misses": "chunks generated when requested",
+}
+
+_lock = threading.Lock()
+_stage_seconds: dict[str, float] = {}
+_stage_count: dict[str, int] = {}
+_counters: dict[str, int] = {}
+
+# stage -> seconds for the current request, None when not collecting
+request_timings: ContextVar[dict[str, float] | None] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def add_time(stage: str, seconds: float) -> None:
+    timings = request_timings.get()
+    with _lock:
+        _stage_seconds[stage] = _stage_seconds.get(stage, 0.0) + seconds
+        _stage_count[stage] = _stage_count.get(stage, 0) + 1
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start)
+
+
+def increment(counter: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + amount
+
+
+def server_timing(timings: dict[str, float]) -> str:
+    """Value of a Server-Timing header, durations in milliseconds"""
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+
+
+def render(gauges: dict[str, float] | None = None) -> str:
+    """All the values in the Prometheus text format, plus the given gauges"""
+    with _lock:
+        seconds = dict(_stage_seconds)
+        counts = dict(_stage_count)
+        counters = dict(_counters)
+    lines = [
+        "# HELP tiled_maps_stage_seconds Time spent in each stage of map generation",
+        "# TYPE tiled_maps_stage_seconds summary",
+    ]
+    for stage in sorted(seconds):
+        lines.append(
+            f'tiled_maps_stage_seconds_sum{{stage="{stage}"}} {seconds[stage]}'
+        )
+        lines.append(
+            f'tiled_maps_stage_seconds_count{{stage="{stage}"}} {counts[stage]}'
+        )
+    for counter in sorted(COUNTERS.keys() | counters.keys()):
+        name = f"tiled_maps_{counter}_total"
+        if counter in COUNTERS:
+            lines.append(f"# HELP {name} {COUNTERS[counter]}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {counters.get(counter, 0)}")
+    for gauge, value in (gauges or {}).items():
+        name = f"tiled_maps_{gauge}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,161 @@
+"""Generate in advance all the chunks of an area.
+
+Chunks are normally generated lazily by the HTTP app when requested,
+this fills the cache folder beforehand using all the cores, for example:
+
+    python -m tiled_maps.pregenerate --chunks -10 -10 10 10
+    python -m tiled_maps.pregenerate --bbox 13.36 52.53 13.40 52.55
+
+Chunks are processed in square blocks, the features of a block are fetched
+with a single query and split locally. With --region the features are also
+drawn once for the whole block instead of once per chunk.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from os import cpu_count
+import time
+
+from tiled_maps.chunks import (
+    GAME_ZOOM_LEVEL,
+    chunk_exists,
+    chunk_lock,
+    generate_chunks,
+    save_chunk,
+    tile_to_chunk,
+)
+from tiled_maps.coordinates import deg_to_tile
+from tiled_maps.feature_source import FeatureSource, open_source
+
+# every worker process keeps its own source, and connection, for all its chunks
+_worker_source: FeatureSource | None = None
+
+
+def _init_worker() -> None:
+    global _worker_source
+    _worker_source = open_source()
+
+
+def _generate(coords: list[tuple[int, int]], overwrite: bool, region: bool) -> int:
+    with ExitStack() as stack:
+        # always in the same order, blocks of other runs can overlap this one
+        for x, y in sorted(coords):
+            stack.enter_context(chunk_lock(x, y))
+        if overwrite:
+            todo = coords
+        else:
+            # another run or the HTTP app could have been faster
+            todo = [(x, y) for x, y in coords if not chunk_exists(x, y)]
+        if len(todo) > 0:
+            for (x, y), tm in generate_chunks(todo, _worker_source, region).items():
+                save_chunk(tm, x, y)
+    return len(coords)
+
+
+def chunks_in_bbox(
+    west: float, south: float, east: float, north: float
+) -> tuple[int, int, int, int]:
+    """Range of chunks, as min_x, min_y, max_x, max_y, covering a bbox in degrees"""
+    min_x, min_y = tile_to_chunk(*deg_to_tile(north, west, GAME_ZOOM_LEVEL))
+    max_x, max_y = tile_to_chunk(*deg_to_tile(south, east, GAME_ZOOM_LEVEL))
+    return min_x, min_y, max_x, max_y
+
+
+def pregenerate(
+    min_x: int,
+    min_y: int,
+    max_x: int,
+    max_y: int,
+    workers: int | None = None,
+    block_size: int = 4,
+    region: bool = False,
+) -> None:
+    """Generate the missing chunks in a rectangle, extremes included"""
+    todo = [
+        (x, y)
+        for y in range(min_y, max_y + 1)
+        for x in range(min_x, max_x + 1)
+        if not chunk_exists(x, y)
+    ]
+    total = (max_x - min_x + 1) * (max_y - min_y + 1)
+    print(
+        f"{total - len(todo)} of {total} chunks already exist, generating {len(todo)}"
+    )
+    generate_in_blocks(todo, workers, block_size, region=region)
+
+
+def generate_in_blocks(
+    todo: list[tuple[int, int]],
+    workers: int | None = None,
+    block_size: int = 4,
+    overwrite: bool = False,
+    region: bool = False,
+) -> None:
+    """Generate and save chunks in parallel, a block of neighbours at a time.
+
+    Without overwrite the chunks that exist when a block starts are skipped.
+    """
+    if len(todo) == 0:
+        return
+    blocks: dict[tuple[int, int], list[tuple[int, int]]] = {}
+    for x, y in todo:
+        blocks.setdefault((x // block_size, y // block_size), []).append((x, y))
+    start = time.time()
+    with ProcessPoolExecutor(
+        max_workers=workers or cpu_count(), initializer=_init_worker
+    ) as executor:
+        futures = [
+            executor.submit(_generate, coords, overwrite, region)
+            for coords in blocks.values()
+        ]
+        done = 0
+        for fut in as_completed(futures):
+            done += fut.result()
+            elapsed = time.time() - start
+            rate = done / elapsed
+            print(
+                f"{done}/{len(todo)} chunks, "
+                f"{rate:.2f} chunks/s, ETA {(len(todo) - done) / rate:.0f}s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    area = parser.add_mutually_exclusive_group(required=True)
+    area.add_argument(
+        "--chunks",
+        nargs=4,
+        type=int,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="rectangle of chunk coordinates, extremes included",
+    )
+    area.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="area in degrees, converted to chunks at the game zoom level",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="processes to use, default all cores"
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=4,
+        help="side of the blocks of chunks fetched with a single query",
+    )
+    parser.add_argument(
+        "--region",
+        action="store_true",
+        help="draw each block as a single map, consistent across chunk borders",
+    )
+    args = parser.parse_args()
+    if args.chunks is not None:
+        area = args.chunks
+    else:
+        area = chunks_in_bbox(*args.bbox)
+    pregenerate(
+        *area, workers=args.workers, block_size=args.block_size, region=args.region
+    )
@@ -0,0 +1,199 @@
+"""Raster tiles of the lower zoom levels built from the ones above them.
+
+The PNG of a tile at the game zoom level is the render of its chunk, a
+tile at a lower zoom is its four children merged and scaled down, so no
+zoom needs the features of large areas. Set RASTER_PYRAMID=1 to serve the
+/zxy_gamified PNG tiles this way on demand, or fill the cache in advance:
+
+    python -m tiled_maps.pyramid --chunks -10 -10 10 10 --min-zoom 10
+
+On demand a request generates at most the chunks of a tile RASTER_PYRAMID_DEPTH
+zooms below the game one, lower tiles show only the areas already cached.
+
+Tiles outside RASTER_MIN_ZOOM and RASTER_MAX_ZOOM are always empty, with
+or without the pyramid.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from os import cpu_count, environ
+import time
+
+from PIL import Image
+
+from tiled_maps.chunks import (
+    GAME_ZOOM_LEVEL,
+    TILE_RESOLUTION,
+    chunk_exists,
+    chunk_to_tile,
+    read_chunk_map,
+    tile_to_chunk,
+)
+from tiled_maps.metrics import timed
+from tiled_maps.raster import encode_png, render_png
+from tiled_maps.tile_cache import TileCache
+
+RASTER_PYRAMID = environ.get("RASTER_PYRAMID", "0") == "1"
+RASTER_MIN_ZOOM = int(environ.get("RASTER_MIN_ZOOM", "0"))
+RASTER_MAX_ZOOM = int(environ.get("RASTER_MAX_ZOOM", "30"))
+# on demand, only tiles up to this many zooms below the game one generate their
+# missing chunks, the lower ones merge the tiles already cached
+RASTER_PYRAMID_DEPTH = int(environ.get("RASTER_PYRAMID_DEPTH", "2"))
+# side of the tiles in pixels, the same at every zoom
+TILE_PIXELS = TILE_RESOLUTION * int(environ["CELL_PIXEL_SIZE"])
+
+
+def in_zoom_range(z: int) -> bool:
+    return RASTER_MIN_ZOOM <= z <= RASTER_MAX_ZOOM
+
+
+def from_pyramid(z: int) -> bool:
+    """Whether a tile at this zoom is built by the pyramid"""
+    return RASTER_PYRAMID and z <= GAME_ZOOM_LEVEL
+
+
+def builds_missing(z: int) -> bool:
+    """Whether a tile at this zoom builds its missing children on demand"""
+    return GAME_ZOOM_LEVEL - z <= RASTER_PYRAMID_DEPTH
+
+
+@lru_cache(maxsize=1)
+def empty_png() -> bytes:
+    return encode_png(Image.new("RGBA", (TILE_PIXELS, TILE_PIXELS), (0, 0, 0, 0)))
+
+
+def tile_key(z: int, x: int, y: int) -> str:
+    """Key of a tile in the TileCache, the same the endpoint uses"""
+    return f"{z}/{x}/{y}.png"
+
+
+def children(x: int, y: int) -> list[tuple[int, int]]:
+    """Tiles at the next zoom covering a tile, as NW, NE, SW, SE"""
+    return [
+        (2 * x, 2 * y),
+        (2 * x + 1, 2 * y),
+        (2 * x, 2 * y + 1),
+        (2 * x + 1, 2 * y + 1),
+    ]
+
+
+def render_chunk_tile(x: int, y: int) -> bytes:
+    """PNG of a tile at the game zoom level, from its chunk already generated"""
+    return render_png(read_chunk_map(*tile_to_chunk(x, y)))
+
+
+def merge_children(pngs: list[bytes]) -> bytes:
+    """The four children PNGs, in the order of children, as a tile of the same size"""
+    half = TILE_PIXELS // 2
+    with timed("render"):
+        out = Image.new("RGBA", (TILE_PIXELS, TILE_PIXELS), (0, 0, 0, 0))
+        for idx, png in enumerate(pngs):
+            with Image.open(BytesIO(png)) as child:
+                small = child.convert("RGBA").resize((half, half), Image.Resampling.BOX)
+            out.paste(small, ((idx % 2) * half, (idx // 2) * half))
+    return encode_png(out)
+
+
+# every worker process uses its own cache instance, on the same folder
+_worker_cache: TileCache | None = None
+
+
+def _cache() -> TileCache:
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = TileCache()
+    return _worker_cache
+
+
+def build_tile(z: int, x: int, y: int) -> bytes:
+    """Build and cache a tile, building its missing children too.
+
+    The chunks of the tiles at the game zoom level must be generated.
+    """
+    cache = _cache()
+    if z == GAME_ZOOM_LEVEL:
+        content = render_chunk_tile(x, y)
+    else:
+        pngs = []
+        for cx, cy in children(x, y):
+            child = cache.get(tile_key(z + 1, cx, cy))
+            pngs.append(build_tile(z + 1, cx, cy) if child is None else child.content)
+        content = merge_children(pngs)
+    cache.put(tile_key(z, x, y), content)
+    return content
+
+
+def build_pyramid(
+    min_x: int,
+    min_y: int,
+    max_x: int,
+    max_y: int,
+    min_zoom: int,
+    workers: int | None = None,
+) -> None:
+    """Cache the tiles of the generated chunks in a rectangle, and the ones of
+    the zooms down to min_zoom they cover entirely.
+
+    A tile at a lower zoom is built only if all its children are, align the
+    rectangle to the tiles of min_zoom to build them all.
+    """
+    tiles = {
+        chunk_to_tile(x, y)
+        for y in range(min_y, max_y + 1)
+        for x in range(min_x, max_x + 1)
+        if chunk_exists(x, y)
+    }
+    with ProcessPoolExecutor(max_workers=workers or cpu_count()) as executor:
+        for z in range(GAME_ZOOM_LEVEL, min_zoom - 1, -1):
+            if len(tiles) == 0:
+                break
+            start = time.time()
+            # a level can start only when the one above is done
+            list(
+                executor.map(
+                    build_tile, [z] * len(tiles), *zip(*sorted(tiles)), chunksize=4
+                )
+            )
+            print(f"Zoom {z}: {len(tiles)} tiles in {time.time() - start:.1f}s")
+            parents = {(x // 2, y // 2) for x, y in tiles}
+            tiles = {
+                parent
+                for parent in parents
+                if all(child in tiles for child in children(*parent))
+            }
+            if len(tiles) < len(parents) and z > min_zoom:
+                print(f"{len(parents) - len(tiles)} tiles of zoom {z - 1} not covered")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--chunks",
+        nargs=4,
+        type=int,
+        required=True,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="rectangle of chunk coordinates, extremes included",
+    )
+    parser.add_argument(
+        "--min-zoom",
+        type=int,
+        default=max(RASTER_MIN_ZOOM, GAME_ZOOM_LEVEL - 6),
+        help="lowest zoom to build",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="processes to use, default all cores"
+    )
+    parser.add_argument(
+        "--generate",
+        action="store_true",
+        help="generate the missing chunks first, like pregenerate",
+    )
+    args = parser.parse_args()
+    if args.generate:
+        from tiled_maps.pregenerate import pregenerate
+
+        pregenerate(*args.chunks, workers=args.workers)
+    build_pyramid(*args.chunks, args.min_zoom, args.workers)
@@ -1,28 +1,131 @@
+from bisect import bisect_right
 from functools import lru_cache
+from io import BytesIO
+from os import environ
+from pathlib import Path
 
+import numpy as np
+from PIL import Image
+
+from tiled_maps.metrics import timed
 from tiled_maps.tiled_helpers import tilemap
-from PIL import Image, ImageDraw
+
+# how many sliced tileset images to keep in memory
+RASTER_TILESETS_CACHED = int(environ.get("RASTER_TILESETS_CACHED", "16"))
 
 
-@lru_cache
-def get_tile_raster(img: str, bbox: tuple[int, int, int, int]) -> Image:
+@lru_cache(maxsize=RASTER_TILESETS_CACHED)
+def sliced_tileset(
+    img: str,
+    tilewidth: int,
+    tileheight: int,
+    columns: int,
+    tilecount: int,
+    margin: int = 0,
+    spacing: int = 0,
+) -> np.ndarray:
+    """All the tiles of a tileset image as an array of (tilecount, h, w, RGBA)"""
     with Image.open(img) as im_in:
-        return im_in.crop(bbox)
+        pixels = np.asarray(im_in.convert("RGBA"))
+    ret = np.zeros((tilecount, tileheight, tilewidth, 4), dtype=np.uint8)
+    for local_id in range(tilecount):
+        left = margin + (local_id % columns) * (tilewidth + spacing)
+        top = margin + (local_id // columns) * (tileheight + spacing)
+        tile = pixels[top : top + tileheight, left : left + tilewidth]
+        ret[local_id, : tile.shape[0], : tile.shape[1]] = tile
+    return ret
+
+
+def tile_palette(tm: tilemap.TiledMap, gids: np.ndarray) -> np.ndarray:
+    """Pixels of the given sorted tile ids, the same order, with size of the map tiles.
+
+    Only the tilesets containing at least one of the ids are loaded.
+    """
+    ret = np.zeros((len(gids), tm.tileheight, tm.tilewidth, 4), dtype=np.uint8)
+    refs = sorted(tm.tilesets, key=lambda tsr: tsr.firstgid)
+    firstgids = [tsr.firstgid for tsr in refs]
+    # each tile id belongs to the last tileset starting before it
+    owners = np.array([bisect_right(firstgids, gid) - 1 for gid in gids.tolist()])
+    for ref_idx in np.unique(owners):
+        if ref_idx < 0:
+            continue
+        tsr = refs[ref_idx]
+        ts = tm.resolve_tileset(tsr)
+        tiles = sliced_tileset(
+            str(Path(ts.path).parent / ts.image),
+            ts.tilewidth,
+            ts.tileheight,
+            ts.columns,
+            ts.tilecount,
+            ts.margin,
+            ts.spacing,
+        )
+        positions = np.nonzero(owners == ref_idx)[0]
+        local_ids = gids[positions] - tsr.firstgid
+        valid = local_ids < ts.tilecount
+        # tiles bigger than the map ones are cropped, as they were when pasted
+        h = min(ts.tileheight, tm.tileheight)
+        w = min(ts.tilewidth, tm.tilewidth)
+        ret[positions[valid], :h, :w] = tiles[local_ids[valid], :h, :w]
+    return ret
 
 
 def render_tilemap(tm: tilemap.TiledMap) -> Image.Image:
-    out = Image.new(
-        "RGBA", (tm.width * tm.tilewidth, tm.height * tm.tileheight), (0, 0, 0, 0)
+    size = (tm.width * tm.tilewidth, tm.height * tm.tileheight)
+    out: Image.Image | None = None
+    tile_layers = [
+        np.asarray(layer.data, dtype=np.uint32).reshape(layer.height, layer.width)
+        for layer in tm.layers
+        if layer.type == "tilelayer"
+    ]
+    if len(tile_layers) == 0:
+        return Image.new("RGBA", size, (0, 0, 0, 0))
+    gids = np.unique(np.concatenate([grid.ravel() for grid in tile_layers]))
+    gids = gids[gids != 0]
+    # index 0 of the palette is the transparent empty tile
+    palette = np.concatenate(
+        [
+            np.zeros((1, tm.tileheight, tm.tilewidth, 4), dtype=np.uint8),
+            tile_palette(tm, gids),
+        ]
     )
-    for layer in tm.layers:
-        if layer.type == "tilelayer":
-            for x, y, id in layer.tiles_with_coords():
-                img, ix, iy, iw, ih = tm.get_static_tile_id_bounds(id)
-                tile_img = get_tile_raster(img, (ix, iy, ix + iw, iy + ih))
-                out.paste(tile_img, (x * tm.tilewidth, y * tm.tileheight))
+    for grid in tile_layers:
+        if not grid.any():
+            continue
+        indexes = np.where(grid == 0, 0, np.searchsorted(gids, grid) + 1)
+        h, w = grid.shape
+        # (h, w, tile h, tile w, RGBA) -> (h * tile h, w * tile w, RGBA)
+        pixels = (
+            palette[indexes]
+            .transpose(0, 2, 1, 3, 4)
+            .reshape(h * tm.tileheight, w * tm.tilewidth, 4)
+        )
+        layer_img = Image.fromarray(pixels, "RGBA")
+        if layer_img.size != size:
+            layer_img = layer_img.crop((0, 0, *size))
+        if out is None:
+            # nothing below, no need to blend
+            out = layer_img
+        else:
+            out.alpha_composite(layer_img)
+    if out is None:
+        return Image.new("RGBA", size, (0, 0, 0, 0))
     return out
 
 
+def encode_png(img: Image.Image) -> bytes:
+    with timed("png_encode"):
+        ret_data = BytesIO()
+        img.save(ret_data, "PNG")
+    return ret_data.getvalue()
+
+
+def render_png(tm: tilemap.TiledMap) -> bytes:
+    with timed("render"):
+        out_image = render_tilemap(tm)
+    return encode_png(out_image)
+
+
 if __name__ == "__main__":
     import json
 
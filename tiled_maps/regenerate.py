@@ -0,0 +1,130 @@
+"""Regenerate the chunks affected by an update of the OSM data.
+
+After importing the new data, pass the ids of the changed features or the
+area that changed. Only the chunks already generated containing them, at
+their old or new position, are generated again, for example:
+
+    python -m tiled_maps.regenerate --osm-ids 1234 -5678
+    python -m tiled_maps.regenerate --osm-ids-file changed_ids.txt
+    python -m tiled_maps.regenerate --bbox 13.36 52.53 13.40 52.55
+
+Chunks not generated yet are left to the HTTP app or to pregenerate.
+"""
+
+import argparse
+import sys
+
+import psycopg
+
+from tiled_maps.chunks import (
+    FEATURE_INDEX_PATH,
+    GAME_ZOOM_LEVEL,
+    existing_chunks,
+    tile_to_chunk,
+)
+from tiled_maps.coordinates import meters_to_tile
+from tiled_maps.database import feature_extents, feature_ids_in_bbox, open_connection
+from tiled_maps.feature_index import chunks_of_features
+from tiled_maps.pregenerate import chunks_in_bbox, generate_in_blocks
+
+
+def _existing_in_range(
+    existing: set[tuple[int, int]], min_x: int, min_y: int, max_x: int, max_y: int
+) -> set[tuple[int, int]]:
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > len(existing):
+        return {
+            (x, y) for x, y in existing if min_x <= x <= max_x and min_y <= y <= max_y
+        }
+    return {
+        (x, y)
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+        if (x, y) in existing
+    }
+
+
+def affected_chunks(
+    osm_ids: list[int], conn: psycopg.Connection
+) -> set[tuple[int, int]]:
+    """Generated chunks where the features were drawn or are now"""
+    existing = existing_chunks()
+    # where they were, deleted features are found only here
+    ret = chunks_of_features(FEATURE_INDEX_PATH, osm_ids) & existing
+    # where they are now, new features are found only here
+    for min_mx, min_my, max_mx, max_my in feature_extents(osm_ids, conn):
+        # Y grows going south
+        min_x, min_y = tile_to_chunk(*meters_to_tile(min_mx, max_my, GAME_ZOOM_LEVEL))
+        max_x, max_y = tile_to_chunk(*meters_to_tile(max_mx, min_my, GAME_ZOOM_LEVEL))
+        ret |= _existing_in_range(existing, min_x, min_y, max_x, max_y)
+    return ret
+
+
+def affected_chunks_bbox(
+    west: float, south: float, east: float, north: float, conn: psycopg.Connection
+) -> set[tuple[int, int]]:
+    """Generated chunks in a bbox, or with features intersecting it"""
+    ret = _existing_in_range(
+        existing_chunks(), *chunks_in_bbox(west, south, east, north)
+    )
+    return ret | affected_chunks(
+        feature_ids_in_bbox(west, south, east, north, conn), conn
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    changes = parser.add_mutually_exclusive_group(required=True)
+    changes.add_argument(
+        "--osm-ids", nargs="+", type=int, help="ids of the changed features"
+    )
+    changes.add_argument(
+        "--osm-ids-file",
+        type=argparse.FileType("r"),
+        help="file with the ids of the changed features, one per line, - for stdin",
+    )
+    changes.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="area in degrees where features changed",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="processes to use, default all cores"
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=4,
+        help="side of the blocks of chunks fetched with a single query",
+    )
+    parser.add_argument(
+        "--region",
+        action="store_true",
+        help="draw each block as a single map, like pregenerate --region",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only list the affected chunks"
+    )
+    args = parser.parse_args()
+    with open_connection() as conn:
+        if args.bbox is not None:
+            chunks = affected_chunks_bbox(*args.bbox, conn)
+        else:
+            if args.osm_ids is not None:
+                ids = args.osm_ids
+            else:
+                ids = [int(line) for line in args.osm_ids_file if line.strip() != ""]
+            chunks = affected_chunks(ids, conn)
+    print(f"{len(chunks)} generated chunks are affected")
+    if args.dry_run:
+        for x, y in sorted(chunks):
+            print(f"{x} {y}")
+        sys.exit(0)
+    generate_in_blocks(
+        sorted(chunks),
+        args.workers,
+        args.block_size,
+        overwrite=True,
+        region=args.region,
+    )
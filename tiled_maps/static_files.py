@@ -0,0 +1,118 @@
+"""Serve files with precompressed gzip and brotli variants.
+
+The variants are sibling files with a .gz or .br suffix. Chunks get them
+when generated, for the other files they can be created in advance with:
+
+    python -m tiled_maps.static_files demo_tilegame2
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+import sys
+import threading
+
+from fastapi.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# variants in order of preference, as (suffix, Content-Encoding)
+VARIANTS = [(".br", "br"), (".gz", "gzip")]
+# smaller files are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def write_atomic(p: Path, content: bytes) -> None:
+    """Write and rename, readers see either the old or the new file, never a part"""
+    tmp = p.with_name(f".{p.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        tmp.write_bytes(content)
+        tmp.replace(p)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def write_precompressed(p: Path, content: bytes) -> None:
+    """Write the compressed variants of a file with the given content"""
+    if len(content) < MIN_COMPRESS_SIZE:
+        for suffix, _ in VARIANTS:
+            p.with_name(p.name + suffix).unlink(missing_ok=True)
+        return
+    write_atomic(p.with_name(p.name + ".gz"), gzip.compress(content, 6, mtime=0))
+    if brotli is not None:
+        write_atomic(p.with_name(p.name + ".br"), brotli.compress(content, quality=5))
+
+
+def precompress_folder(folder: Path, pattern: str = "**/*.json") -> int:
+    """Create the missing or outdated variants for the files in a folder"""
+    done = 0
+    for p in folder.glob(pattern):
+        gz = p.with_name(p.name + ".gz")
+        if gz.exists() and gz.stat().st_mtime >= p.stat().st_mtime:
+            continue
+        write_precompressed(p, p.read_bytes())
+        done += 1
+    return done
+
+
+def accepted_encodings(accept_encoding: str | None) -> set[str]:
+    """Encodings in an Accept-Encoding header, except the ones with q=0"""
+    ret = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        params = params.strip().replace(" ", "")
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        ret.add(name.strip().lower())
+    return ret
+
+
+def static_response(
+    p: Path,
+    accept_encoding: str | None,
+    if_none_match: str | None = None,
+    cache_control: str = "no-cache",
+) -> Response:
+    """Response for a file, using the best precompressed variant the client accepts.
+
+    The ETag depends on the file version and on the variant, so a client
+    gets a 304 for an unchanged file.
+    """
+    stat = p.stat()
+    tag_base = hashlib.blake2b(
+        f"{p}-{stat.st_mtime_ns}-{stat.st_size}".encode(), digest_size=12
+    ).hexdigest()
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    served = p
+    accepted = accepted_encodings(accept_encoding)
+    for suffix, encoding in VARIANTS:
+        variant = p.with_name(p.name + suffix)
+        if encoding in accepted and variant.is_file():
+            # an older variant is left from a previous version of the file
+            if variant.stat().st_mtime_ns >= stat.st_mtime_ns:
+                served = variant
+                headers["Content-Encoding"] = encoding
+                tag_base += f"-{encoding}"
+                break
+    headers["ETag"] = f'"{tag_base}"'
+    if if_none_match is not None and headers["ETag"] in [
+        t.strip() for t in if_none_match.split(",")
+    ]:
+        return Response(status_code=304, headers=headers)
+    # the media type is the one of the original file, not of the variant
+    return FileResponse(
+        served, headers=headers, media_type=mimetypes.guess_type(p.name)[0]
+    )
+
+
+if __name__ == "__main__":
+    folder = Path(sys.argv[1])
+    print(f"Compressed {precompress_folder(folder)} files in {folder}")
@@ -0,0 +1,202 @@
+"""Two tiers cache for the raster endpoint tiles, in memory and on disk.
+
+Tiles are stored under a version string that changes when the tilesets
+change or when the cache is invalidated, for example after a new OSM import:
+
+    python -m tiled_maps.tile_cache --invalidate
+"""
+
+import argparse
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+from os import environ
+from pathlib import Path
+import shutil
+from stat import S_ISREG
+import threading
+import time
+
+from tiled_maps.static_files import write_atomic
+from tiled_maps.tiled_helpers.tile_catalog import TILESETS_FOLDER
+
+RASTER_CACHE_DIR = Path(environ.get("RASTER_CACHE_DIR", "raster_cache"))
+RASTER_CACHE_MEMORY_MB = int(environ.get("RASTER_CACHE_MEMORY_MB", "64"))
+RASTER_CACHE_DISK_MB = int(environ.get("RASTER_CACHE_DISK_MB", "1024"))
+# optional, set it to anything identifying the OSM import in use
+OSM_DATA_VERSION = environ.get("OSM_DATA_VERSION", "")
+
+# the version is recomputed at most this often, in seconds
+VERSION_CHECK_INTERVAL = 5
+
+
+@dataclass
+class CachedTile:
+    content: bytes
+    etag: str
+    # UNIX timestamp
+    last_modified: float
+
+    def last_modified_header(self) -> str:
+        return formatdate(self.last_modified, usegmt=True)
+
+    def matches(self, if_none_match: str | None, if_modified_since: str | None) -> bool:
+        """Whether a conditional GET with these headers can get a 304"""
+        if if_none_match is not None:
+            return self.etag in [t.strip() for t in if_none_match.split(",")]
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates have a resolution of one second
+            return int(self.last_modified) <= since
+        return False
+
+
+def make_etag(content: bytes) -> str:
+    return '"' + hashlib.blake2b(content, digest_size=16).hexdigest() + '"'
+
+
+class TileCache:
+    def __init__(
+        self,
+        folder: Path = RASTER_CACHE_DIR,
+        memory_bytes: int = RASTER_CACHE_MEMORY_MB * 1024 * 1024,
+        disk_bytes: int = RASTER_CACHE_DISK_MB * 1024 * 1024,
+    ):
+        self.folder = folder
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, CachedTile] = OrderedDict()
+        self._memory_used = 0
+        # approximated, other processes write in the same folder
+        self._disk_used: int | None = None
+        self._lock = threading.Lock()
+        self._version = ""
+        self._version_checked: float | None = None
+
+    def version(self) -> str:
+        """Identifier of the data the cached tiles were generated from"""
+        now = time.monotonic()
+        if (
+            self._version_checked is not None
+            and now - self._version_checked < VERSION_CHECK_INTERVAL
+        ):
+            return self._version
+        h = hashlib.blake2b(OSM_DATA_VERSION.encode(), digest_size=8)
+        for p in sorted(TILESETS_FOLDER.rglob("*")):
+            if p.suffix in (".json", ".png"):
+                h.update(f"{p}:{p.stat().st_mtime_ns}".encode())
+        marker = self.folder / "generation"
+        if marker.exists():
+            h.update(marker.read_bytes())
+        self._version = h.hexdigest()
+        self._version_checked = now
+        return self._version
+
+    def _disk_path(self, key: str) -> Path:
+        return self.folder / self.version() / key
+
+    def get_memory(self, key: str) -> CachedTile | None:
+        """A tile from the memory tier only, it never reads the tiles on disk"""
+        mem_key = f"{self.version()}/{key}"
+        with self._lock:
+            if mem_key in self._memory:
+                self._memory.move_to_end(mem_key)
+                return self._memory[mem_key]
+        return None
+
+    def get(self, key: str) -> CachedTile | None:
+        tile = self.get_memory(key)
+        if tile is not None:
+            return tile
+        p = self._disk_path(key)
+        try:
+            content = p.read_bytes()
+            last_modified = p.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        tile = CachedTile(content, make_etag(content), last_modified)
+        self._remember(f"{self.version()}/{key}", tile)
+        return tile
+
+    def put(self, key: str, content: bytes) -> CachedTile:
+        tile = CachedTile(content, make_etag(content), time.time())
+        self._remember(f"{self.version()}/{key}", tile)
+        p = self._disk_path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        # other processes never see a partial file
+        write_atomic(p, content)
+        self._evict_disk(len(content))
+        return tile
+
+    def _remember(self, mem_key: str, tile: CachedTile) -> None:
+        with self._lock:
+            if mem_key in self._memory:
+                self._memory_used -= len(self._memory.pop(mem_key).content)
+            self._memory[mem_key] = tile
+            self._memory_used += len(tile.content)
+            while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_used -= len(old.content)
+
+    def _cached_files(self) -> list[tuple[float, int, Path]]:
+        """Modification time, size and path of the cached tiles.
+
+        Files being written by other processes are left out, and so are the
+        ones they remove meanwhile.
+        """
+        ret = []
+        for p in self.folder.rglob("*"):
+            if p.name.startswith(".") or p.name == "generation":
+                continue
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            if S_ISREG(stat.st_mode):
+                ret.append((stat.st_mtime, stat.st_size, p))
+        return ret
+
+    def _evict_disk(self, added: int) -> None:
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(size for _, size, _ in self._cached_files())
+            else:
+                self._disk_used += added
+            if self._disk_used <= self.disk_bytes:
+                return
+            # remove the least recently written files, down to 90% of the limit
+            files = sorted(self._cached_files())
+            self._disk_used = sum(size for _, size, _ in files)
+            for _, size, p in files:
+                if self._disk_used <= self.disk_bytes * 0.9:
+                    break
+                p.unlink(missing_ok=True)
+                self._disk_used -= size
+
+    def invalidate(self) -> None:
+        """Drop every cached tile, in this and in the other processes"""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        (self.folder / "generation").write_text(str(time.time_ns()))
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+            self._version_checked = None
+            for p in self.folder.iterdir():
+                if p.is_dir():
+                    shutil.rmtree(p, ignore_errors=True)
+            self._disk_used = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--invalidate", action="store_true", help="drop all the cached tiles"
+    )
+    args = parser.parse_args()
+    if args.invalidate:
+        TileCache().invalidate()
+        print(f"Invalidated the tile cache in {RASTER_CACHE_DIR}")
@@ -0,0 +1,117 @@
+"""Tile layer data encodings supported by Tiled.
+
+Data is either a plain list of tile ids ("csv" in Tiled terms) or the
+base64 of the little-endian uint32 ids, optionally compressed with zlib,
+gzip or zstd. Run this module to compare the encodings on a map:
+
+    python -m tiled_maps.tiled_helpers.encoding demo_tilegame2/maps/generated/chunk_0_0.json
+"""
+
+import base64
+import gzip
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# accepted values for the LAYER_ENCODING setting, as (encoding, compression)
+ENCODINGS = {
+    "csv": ("csv", ""),
+    "base64": ("base64", ""),
+    "base64-zlib": ("base64", "zlib"),
+    "base64-gzip": ("base64", "gzip"),
+    "base64-zstd": ("base64", "zstd"),
+}
+
+
+def _compress(raw: bytes, compression: str, level: int) -> bytes:
+    if compression == "":
+        return raw
+    elif compression == "zlib":
+        return zlib.compress(raw, level)
+    elif compression == "gzip":
+        # mtime is fixed so the same data always gives the same bytes
+        return gzip.compress(raw, 9 if level == -1 else level, mtime=0)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level == -1 else level).compress(raw)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def _decompress(raw: bytes, compression: str) -> bytes:
+    if compression == "":
+        return raw
+    elif compression == "zlib":
+        return zlib.decompress(raw)
+    elif compression == "gzip":
+        return gzip.decompress(raw)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def encode_layer_data(
+    data: np.ndarray, encoding: str = "csv", compression: str = "", level: int = -1
+) -> list[int] | str:
+    """Layer data as it goes in the Tiled JSON"""
+    if encoding == "csv":
+        return data.tolist()
+    elif encoding == "base64":
+        raw = data.astype("<u4").tobytes()
+        return base64.b64encode(_compress(raw, compression, level)).decode("ascii")
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def decode_layer_data(
+    data: list[int] | str | np.ndarray, encoding: str = "csv", compression: str = ""
+) -> np.ndarray:
+    """Inverse of encode_layer_data, gives the uint32 tile ids"""
+    if encoding == "csv" or not isinstance(data, str):
+        return np.asarray(data, dtype=np.uint32)
+    elif encoding == "base64":
+        raw = _decompress(base64.b64decode(data), compression)
+        return np.frombuffer(raw, dtype="<u4").astype(np.uint32)
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+    import time
+
+    from tiled_maps.tiled_helpers import tilemap
+
+    map_path = sys.argv[1]
+    with open(map_path) as fr:
+        raw_map = json.load(fr)
+    # the events layer is not a tile layer, and it's the same for every encoding
+    raw_map["layers"] = [l for l in raw_map["layers"] if l["type"] == "tilelayer"]
+    tm = tilemap.from_data(raw_map | dict(path=map_path))
+    repetitions = 20
+    print("encoding       size (bytes)  encode (ms)  load (ms)")
+    for name, (encoding, compression) in ENCODINGS.items():
+        if compression == "zstd" and zstandard is None:
+            print(f"{name:<14} skipped, zstandard is not installed")
+            continue
+        for layer in tm.layers:
+            layer.encoding = encoding
+            layer.compression = compression
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            serialized = json.dumps(tm.to_dict())
+        encode_time = (time.perf_counter() - start) / repetitions
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            tilemap.from_data(json.loads(serialized))
+        load_time = (time.perf_counter() - start) / repetitions
+        print(
+            f"{name:<14} {len(serialized):>12}  "
+            f"{encode_time * 1000:>11.2f}  {load_time * 1000:>9.2f}"
+        )
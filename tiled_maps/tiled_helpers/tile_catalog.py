@@ -1,17 +1,31 @@
 from pathlib import Path
 import json
 from os.path import relpath
+import threading
 
 from tiled_maps.tiled_helpers.tilemap import TileSetRef, TileSetTileDef
 from tiled_maps.tiled_helpers.tileset import TileSet
 
+TILESETS_FOLDER = Path("demo_tilegame2/spritesheets/")
+
 
 class TileCatalog:
     tilesets: list[TileSet]
 
     def __init__(self, tilesets):
         self.tilesets = tilesets
+        # index all the tile names at once, if a name is repeated the first wins
         self._tilenamecache: dict[str, int] = {}
+        currentgid = 1
+        for ts in self.tilesets:
+            if ts.tiles is not None:
+                for tile_props in ts.tiles:
+                    for p in tile_props.properties:
+                        if p["name"] == "name":
+                            self._tilenamecache.setdefault(
+                                p["value"], currentgid + tile_props.id
+                            )
+            currentgid += ts.tilecount
 
     def dump_references_for_map(self, map_path: Path) -> list[TileSetRef]:
         ret = []
@@ -24,21 +38,10 @@ class TileCatalog:
         return ret
 
     def get_tile_by_name(self, name: str) -> int:
-        if name in self._tilenamecache:
+        try:
             return self._tilenamecache[name]
-        currentgid = 1
-        for ts in self.tilesets:
-            if ts.tiles is not None:
-                for tile_props in ts.tiles:
-                    if any(
-                        p["name"] == "name" and p["value"] == name
-                        for p in tile_props.properties
-                    ):
-                        this_gid = currentgid + tile_props.id
-                        self._tilenamecache[name] = this_gid
-                        return this_gid
-            currentgid += ts.tilecount
-        raise KeyError(f"Tile {name} not found")
+        except KeyError:
+            raise KeyError(f"Tile {name} not found")
 
 
 def scan_tileset_folder(folder: Path) -> TileCatalog:
@@ -51,7 +54,31 @@ def scan_tileset_folder(folder: Path) -> TileCatalog:
                 raw_data["tiles"] = [
                     TileSetTileDef(**tsd)
                     for tsd in raw_data["tiles"]
-                    if 'animation' not in tsd
+                    if "animation" not in tsd
                 ]
             ret.append(TileSet(path=str(p), **raw_data))
     return TileCatalog(tilesets=ret)
+
+
+# catalogs already scanned, with the signature of the folder at scan time
+_catalogs: dict[Path, tuple[tuple, TileCatalog]] = {}
+_catalogs_lock = threading.Lock()
+
+
+def _folder_signature(folder: Path) -> tuple:
+    return tuple(sorted((p.name, p.stat().st_mtime_ns) for p in folder.glob("*.json")))
+
+
+def get_catalog(folder: Path = TILESETS_FOLDER) -> TileCatalog:
+    """Same as scan_tileset_folder, but scans again only when the files change.
+
+    The returned catalog is shared and must not be modified.
+    """
+    signature = _folder_signature(folder)
+    with _catalogs_lock:
+        cached = _catalogs.get(folder)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        catalog = scan_tileset_folder(folder)
+        _catalogs[folder] = (signature, catalog)
+        return catalog
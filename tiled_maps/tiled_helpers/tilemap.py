@@ -1,8 +1,14 @@
+from bisect import bisect_right
 from dataclasses import dataclass
 from pathlib import Path
 import json
 from typing import Generator
-from tiled_maps.tiled_helpers.tileset import TileSet, TileSetTileDef
+
+import numpy as np
+import orjson
+
+from tiled_maps.tiled_helpers.encoding import decode_layer_data, encode_layer_data
+from tiled_maps.tiled_helpers.tileset import TileSet, TileSetTileDef, load_tileset
 
 
 @dataclass
@@ -12,42 +18,84 @@ class Layer:
     id: int
     name: str
     type: str
-    data: list[int]
+    # tile ids, row by row, as uint32, lists are converted when creating the layer
+    data: np.ndarray
     opacity: float = 1.0
     visible: bool = True
     x: int = 0
     y: int = 0
+    # how data is written in the JSON, see the encoding module
+    encoding: str = "csv"
+    compression: str = ""
+
+    def __post_init__(self):
+        self.data = decode_layer_data(self.data, self.encoding, self.compression)
+
+    def grid(self) -> np.ndarray:
+        """A (height, width) view of the data, changes to it affect the layer"""
+        return self.data.reshape(self.height, self.width)
 
     def tiles_with_coords(self, ignore_zero: bool = True):
-        for idx, tid in enumerate(self.data):
-            if tid == 0 and ignore_zero:
-                continue
-            yield ((idx % self.width) - self.x, (idx // self.height) - self.y, tid)
+        if ignore_zero:
+            indexes = np.flatnonzero(self.data)
+        else:
+            indexes = np.arange(len(self.data))
+        for idx, tid in zip(indexes.tolist(), self.data[indexes].tolist()):
+            yield ((idx % self.width) - self.x, (idx // self.width) - self.y, tid)
 
     def set_tile(self, x: int, y: int, tid: int) -> None:
-        try:
+        if 0 <= x < self.width and 0 <= y < self.height:
             self.data[x + y * self.width] = tid
-        except IndexError:
+        else:
             # TODO maybe the caller should handle this?
             print(f"IndexError: {x}, {y}, {tid}")
 
     def is_empty(self, x, y) -> bool:
-        try:
+        if 0 <= x < self.width and 0 <= y < self.height:
             return self.data[x + y * self.width] == 0
-        except IndexError:
-            # TODO maybe the caller should handle this?
-            return True
+        # TODO maybe the caller should handle this?
+        return True
 
-    def to_dict(self) -> dict:
+    def set_tiles(self, indexes: np.ndarray, tid: int) -> None:
+        """Set the same tile id at many indexes of data at once"""
+        self.data[indexes] = tid
+
+    def all_empty(self, indexes: np.ndarray) -> bool:
+        """True if there's no tile at any of the given indexes of data"""
+        return not self.data[indexes].any()
+
+    def blit(self, grid: np.ndarray, x: int, y: int) -> None:
+        """Copy a 2D grid of tile ids with its top left corner at x, y.
+
+        The parts of the grid outside the layer are ignored.
+        """
+        target = self.grid()
+        h, w = grid.shape
+        top, left = max(y, 0), max(x, 0)
+        bottom, right = min(y + h, self.height), min(x + w, self.width)
+        if top >= bottom or left >= right:
+            return
+        source = grid[top - y : bottom - y, left - x : right - x]
+        target[top:bottom, left:right] = source
+
+    def to_dict(self, compressionlevel: int = -1, numpy_data: bool = False) -> dict:
         """An object that can be dumped as valid Tiled JSON"""
         ret = {}
         for k, v in self.__dict__.items():
-            if type(v) in (str, int, float, bool):
+            if k in ("encoding", "compression"):
+                # Tiled omits them for the default plain list
+                if self.encoding != "csv":
+                    ret[k] = v
+            elif type(v) in (str, int, float, bool):
                 ret[k] = v
             elif isinstance(v, Path):
                 ret[k] = str(v)
-            elif k == "data":
+            elif k == "data" and numpy_data and self.encoding == "csv":
                 ret[k] = v
+            elif k == "data":
+                ret[k] = encode_layer_data(
+                    v, self.encoding, self.compression, compressionlevel
+                )
             else:
                 raise ValueError(f"How to serialize {k} of type {type(v)}?")
         return ret
@@ -88,55 +136,120 @@ class TiledMap:
     # x, y, name, props
     event_data: list[tuple[int, int, str, dict]] | None = None
     event_files: list[tuple[str, str]] | None = None
+    # OSM ids of the features drawn in a generated map, not part of the JSON
+    feature_ids: list[int] | None = None
 
     def resolve_tileset(self, tsr: TileSetRef) -> TileSet:
         """Fetches the actual tileset from the reference in the map."""
-        # TODO cache this
         # TODO create helpers to handle paths according to Tiled logic
-        with open(Path(self.path).parent / tsr.source) as tr:
-            tileset_data = json.load(tr)
-            if "tiles" in tileset_data:
-                tileset_data["tiles"] = [
-                    TileSetTileDef(**tsd) for tsd in tileset_data["tiles"]
-                ]
-            return TileSet(
-                path=str(Path(self.path).parent / tsr.source), **tileset_data
-            )
+        return load_tileset(Path(self.path).parent / tsr.source)
+
+    def find_tileset(self, tid: int) -> tuple[TileSetRef, TileSet]:
+        """Get the tileset containing a tile id, with a binary search"""
+        if "_firstgids" not in self.__dict__:
+            # built on first use, the tilesets of a map are not expected to change
+            self._sorted_tilesets = sorted(self.tilesets, key=lambda t: t.firstgid)
+            self._firstgids = [tsr.firstgid for tsr in self._sorted_tilesets]
+            self._resolved: dict[int, TileSet] = {}
+        idx = bisect_right(self._firstgids, tid) - 1
+        if idx < 0:
+            raise KeyError(f"No tiles found for {tid}")
+        tsr = self._sorted_tilesets[idx]
+        if tsr.firstgid not in self._resolved:
+            self._resolved[tsr.firstgid] = self.resolve_tileset(tsr)
+        ts = self._resolved[tsr.firstgid]
+        if tid - tsr.firstgid >= ts.tilecount:
+            raise KeyError(f"No tiles found for {tid}")
+        return tsr, ts
 
     def get_static_tile_id_bounds(self, tid: int):
         """Get the image path and bounds of a tile id"""
-        for tsr in self.tilesets:
-            if tsr.firstgid <= tid:
-                ts = self.resolve_tileset(tsr)
-                if ts.tilecount + tsr.firstgid <= tid:
-                    continue
-                local_id = tid - tsr.firstgid
-                return (
-                    Path(ts.path).parent / ts.image,
-                    ts.tilewidth * (local_id % (ts.imagewidth / ts.tilewidth)),
-                    ts.tileheight * (local_id // (ts.imagewidth / ts.tilewidth)),
-                    ts.tilewidth,
-                    ts.tileheight,
-                )
-        raise KeyError(f"No tiles found for {tid}")
+        tsr, ts = self.find_tileset(tid)
+        local_id = tid - tsr.firstgid
+        return (
+            Path(ts.path).parent / ts.image,
+            ts.margin + (ts.tilewidth + ts.spacing) * (local_id % ts.columns),
+            ts.margin + (ts.tileheight + ts.spacing) * (local_id // ts.columns),
+            ts.tilewidth,
+            ts.tileheight,
+        )
 
     def add_event(
         self, x: int, y: int, name: str, props: dict, content: list[str]
     ) -> None:
-        """Add an event file to the map"""
-        # TODO event content here should be stored with a separate function
-        # right now we just assume the name and content are always paired
+        """Add an event file to the map.
+
+        Event files are next to the map, so the relative paths in their content
+        work, and named after it, so maps in the same folder do not overwrite
+        each other's events.
+        """
         if self.event_data is None:
             self.event_data = []
             self.event_files = []
         self.event_data.append((x * self.tilewidth, y * self.tileheight, name, props))
-        self.event_files.append((f"{name}.json", json.dumps(content, indent=2)))
+        self.__dict__.pop("_events_layer_json", None)
+        event_path = f"{Path(self.path).stem}_{name}_{len(self.event_data)}.json"
+        self.event_files.append((event_path, json.dumps(content, indent=2)))
 
-    def to_dict(self) -> dict:
-        """An object that can be dumped as valid Tiled JSON"""
+    def events_layer(self) -> dict:
+        """The object layer with the events.
+
+        It's built once until an event is added and kept encoded, every call
+        returns a new copy that the caller can change.
+        """
+        if "_events_layer_json" in self.__dict__:
+            return orjson.loads(self._events_layer_json)
+        layer = {
+            "draworder": "topdown",
+            "id": len(self.layers) + 2,
+            "name": "events",
+            "offsety": 1,
+            "opacity": 1,
+            "type": "objectgroup",
+            "visible": True,
+            "x": 0,
+            "y": 0,
+            "objects": [
+                {
+                    "height": 1,
+                    "id": idx + 1,
+                    "name": name,
+                    "properties": [
+                        {
+                            "name": "event_path",
+                            "type": "string",
+                            "value": event_path,
+                        }
+                    ]
+                    + [dict(name=k, type="string", value=v) for k, v in props.items()],
+                    "rotation": 0,
+                    "type": "event",
+                    "visible": True,
+                    "width": 1,
+                    "x": x,
+                    "y": y,
+                }
+                for idx, ((x, y, name, props), (event_path, _)) in enumerate(
+                    zip(self.event_data or [], self.event_files or [])
+                )
+            ],
+        }
+        self._events_layer_json = orjson.dumps(layer)
+        return layer
+
+    def to_dict(self, numpy_data: bool = False) -> dict:
+        """An object that can be dumped as valid Tiled JSON.
+
+        With numpy_data, plain list layer data is left as arrays, for
+        serializers able to write them directly.
+        """
         ret = {}
-        for k, v in self.__dict__.items():
-            if type(v) in (str, int, float, bool):
+        # a copy, building the events layer adds it to the internal caches
+        for k, v in list(self.__dict__.items()):
+            if k.startswith("_"):
+                # internal caches, not part of the map
+                continue
+            elif type(v) in (str, int, float, bool):
                 ret[k] = v
             elif isinstance(v, Path):
                 ret[k] = str(v)
@@ -146,51 +259,16 @@ class TiledMap:
                 # we don't know if the event layers has been seen before or after
                 # so always append
                 # hopefully later this can be replaced with a proper Pydantic type
-                ret[k] = ret[k] + [l.to_dict() for l in v]
+                ret[k] = ret[k] + [
+                    l.to_dict(self.compressionlevel, numpy_data) for l in v
+                ]
             elif k == "tilesets" and type(v) == list:
                 ret[k] = [tsr.to_dict() for tsr in v]
             elif k == "event_data" and type(v) == list:
                 if "layers" not in ret:
                     ret["layers"] = []
-                ret["layers"].append(
-                    {
-                        "draworder": "topdown",
-                        "id": len(self.layers) + 2,
-                        "name": "events",
-                        "offsety": 1,
-                        "opacity": 1,
-                        "type": "objectgroup",
-                        "visible": True,
-                        "x": 0,
-                        "y": 0,
-                        "objects": [
-                            {
-                                "height": 1,
-                                "id": idx + 1,
-                                "name": name,
-                                "properties": [
-                                    {
-                                        "name": "event_path",
-                                        "type": "string",
-                                        "value": f"{name}.json",
-                                    }
-                                ]
-                                + [
-                                    dict(name=k, type="string", value=v)
-                                    for k, v in props.items()
-                                ],
-                                "rotation": 0,
-                                "type": "event",
-                                "visible": True,
-                                "width": 1,
-                                "x": x,
-                                "y": y,
-                            }
-                            for idx, (x, y, name, props) in enumerate(self.event_data)
-                        ],
-                    }
-                )
-            elif k == "event_files":
+                ret["layers"].append(self.events_layer())
+            elif k in ("event_files", "feature_ids"):
                 # these are going to their own files, ignored here
                 continue
             elif k == "event_data" and v is None:
@@ -200,6 +278,12 @@ class TiledMap:
                 raise ValueError(f"How to serialize {k} of type {type(v)}?")
         return ret
 
+    def to_json_bytes(self) -> bytes:
+        """The Tiled JSON of the map, encoded in one pass"""
+        return orjson.dumps(
+            self.to_dict(numpy_data=True), option=orjson.OPT_SERIALIZE_NUMPY
+        )
+
     def get_event_files(self) -> Generator[tuple[str, str], None, None]:
         """Yields the event files as pairs of (path, content)"""
         if self.event_files is None:
@@ -1,4 +1,8 @@
 from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import threading
 
 
 @dataclass
@@ -25,3 +29,38 @@ class TileSet:
     path: str
     wangsets: list[dict] = None
     tiles: list[TileSetTileDef] | None = None
+
+
+# parsed tilesets, by resolved path, with the mtime they were parsed at
+_registry: dict[Path, tuple[int, TileSet]] = {}
+_registry_lock = threading.Lock()
+
+
+def parse_tileset(path: str | Path) -> TileSet:
+    """Read a tileset file, animated tiles are ignored"""
+    with open(path) as tr:
+        tileset_data = json.load(tr)
+    if "tiles" in tileset_data:
+        tileset_data["tiles"] = [
+            TileSetTileDef(**tsd)
+            for tsd in tileset_data["tiles"]
+            if "animation" not in tsd
+        ]
+    return TileSet(path=str(path), **tileset_data)
+
+
+def load_tileset(path: str | Path) -> TileSet:
+    """Same as parse_tileset, but parses each file only once per process.
+
+    The file is read again only when its modification time changes.
+    """
+    resolved = Path(path).resolve()
+    mtime = os.stat(resolved).st_mtime_ns
+    with _registry_lock:
+        cached = _registry.get(resolved)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    ts = parse_tileset(os.path.normpath(path))
+    with _registry_lock:
+        _registry[resolved] = (mtime, ts)
+    return ts
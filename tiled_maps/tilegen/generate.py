@@ -1,17 +1,32 @@
 from dataclasses import dataclass
-from pathlib import Path
-from typing import Generator
 from os import environ
+import time
+from typing import Generator, Iterable
 
-import psycopg
-from shapely.geometry import shape, box
+import numpy as np
+from shapely.geometry import shape
 
 from tiled_maps.tiled_helpers.tilemap import TiledMap, Layer
-from tiled_maps.tiled_helpers.tile_catalog import scan_tileset_folder, TileCatalog
+from tiled_maps.tiled_helpers.tile_catalog import get_catalog, TileCatalog
+from tiled_maps.tiled_helpers.encoding import ENCODINGS
+from tiled_maps.metrics import add_time, increment
 
-from tiled_maps.database import retrieve_features, cell_bbox
+from tiled_maps.coordinates import tile_envelope, tile_size_meters
+from tiled_maps.feature_source import FeatureSource
+from tiled_maps.tilegen.rasterize import covered_cells, flat_index
+from tiled_maps.tilegen.rules import (
+    FeatureRules,
+    get_rules,
+    get_tag_filter,
+    get_tag_keys,
+)
 
 CELL_PIXEL_SIZE = int(environ["CELL_PIXEL_SIZE"])
+# one of the keys of encoding.ENCODINGS
+LAYER_ENCODING, LAYER_COMPRESSION = ENCODINGS[environ.get("LAYER_ENCODING", "csv")]
+# set to 1 to clip and simplify the geometries in PostGIS, and fetch only the
+# tags used by the rules, the covered cells can differ slightly at the borders
+FEATURES_PUSHDOWN = environ.get("FEATURES_PUSHDOWN", "0") == "1"
 
 
 @dataclass
@@ -25,147 +40,75 @@ class Event:
 
 @dataclass
 class TiledRepresentation:
-    ground: dict[tuple[int, int], int]
-    meter1: dict[tuple[int, int], int]
+    # pairs of (indexes in the layer data, tile id to put there)
+    ground: list[tuple[np.ndarray, int]]
+    meter1: list[tuple[np.ndarray, int]]
     events: list[Event]
 
 
-def get_covered_points(
-    tile_bbox: tuple[float, float, float, float],
-    geom_bbox: tuple[float, float, float, float],
-    cell_width: float,
-    cell_height: float,
-) -> Generator[tuple[int, int, box], None, None]:
-    min_x, max_x, min_y, max_y = tile_bbox
-    g_min_x, g_min_y, g_max_x, g_max_y = geom_bbox
-    cur_y = max(g_min_y, min_y) - cell_height
-    while cur_y <= min(max_y, g_max_y) + cell_height:
-        cur_x = max(g_min_x, min_x) - cell_width
-        while cur_x < min(max_x, g_max_x):
-            if cur_x >= min_x and cur_y > min_y:
-                yield (
-                    int((cur_x - min_x) / cell_width),
-                    # NOTE: y coordinate uses computer graphic convention,
-                    # not cartesian
-                    int((max_y - cur_y) / cell_height),
-                    box(cur_x, cur_y, cur_x + cell_width, cur_y + cell_height),
-                )
-            cur_x += cell_width
-        cur_y += cell_height
-
-
 def represent_feature(
     osm_id: int,
     geom: shape,
     tags: dict,
-    catalog: TileCatalog,
+    rules: FeatureRules,
     bbox: tuple[float, float, float, float],
     cell_width: float,
     cell_height: float,
+    width: int,
+    height: int,
 ) -> TiledRepresentation | None:
-    if "building" in tags:
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.ground[(x, y)] = catalog.get_tile_by_name("wall_bright")
-        return tr
-    elif tags.get("highway") in ("footway", "pedestrian"):
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.ground[(x, y)] = catalog.get_tile_by_name("dirt_a")
-        return tr
-    elif tags.get("highway") in ("residential", "primary", "secondary"):
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        xcoords = []
-        ycoords = []
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.ground[(x, y)] = catalog.get_tile_by_name("paved_road_a")
-                xcoords.append(x)
-                ycoords.append(y)
-        # average x, y coordinates to get the center of the road
-        if len(xcoords) > 0:
-            x = int(sum(xcoords) / len(xcoords))
-            y = int(sum(ycoords) / len(ycoords))
-            tr.events.append(
-                Event(
-                    x,
-                    y,
-                    "road",
-                    dict(roadname=tags.get("name", "unnamed road")),
-                    [
-                        {
-                            "conditions": [],
-                            "aspect": {
-                                "spritesheet": "../../spritesheets/events/road.json",
-                                "z_index": 100,
-                                "collide": "yes",
-                            },
-                            "on_interact": [
-                                {
-                                    "command": "say",
-                                    "msgs": [
-                                        "Hello!",
-                                        "This is a road, $roadname",
-                                    ],
-                                }
-                            ],
-                        }
-                    ],
-                )
-            )
-        return tr
-    elif tags.get("natural") == "water":
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.ground[(x, y)] = catalog.get_tile_by_name("water_a")
-        return tr
-    elif tags.get("landuse") == "grass":
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        park_tile_gid = catalog.get_tile_by_name("park_a")
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.ground[(x, y)] = park_tile_gid
-        return tr
-    elif tags.get("natural") == "tree":
-        tr = TiledRepresentation(ground={}, meter1={}, events=[])
-        for x, y, p in get_covered_points(bbox, geom.bounds, cell_width, cell_height):
-            if p.intersects(geom):
-                tr.meter1[(x, y - 1)] = catalog.get_tile_by_name("tree_small_1")
-                tr.meter1[(x + 1, y - 1)] = catalog.get_tile_by_name("tree_small_2")
-                tr.meter1[(x, y)] = catalog.get_tile_by_name("tree_small_3")
-                tr.meter1[(x + 1, y)] = catalog.get_tile_by_name("tree_small_4")
-                tr.meter1[(x, y + 1)] = catalog.get_tile_by_name("tree_small_5")
-                tr.meter1[(x + 1, y + 1)] = catalog.get_tile_by_name("tree_small_6")
-
-        return tr
-    else:
+    start = time.perf_counter()
+    rule = rules.classify(tags)
+    classified = time.perf_counter()
+    add_time("classify", classified - start)
+    if rule is None:
         return None
+    xs, ys = covered_cells(geom, bbox, cell_width, cell_height, width, height)
+    add_time("rasterize", time.perf_counter() - classified)
+    tr = TiledRepresentation(ground=[], meter1=[], events=[])
+    if rule.ground is not None:
+        tr.ground.append((flat_index(xs, ys, width, height), rule.ground))
+    for dx, dy, tid in rule.meter1:
+        tr.meter1.append((flat_index(xs + dx, ys + dy, width, height), tid))
+    # average x, y coordinates to get the center of the feature
+    if rule.event is not None and len(xs) > 0:
+        tr.events.append(
+            Event(
+                int(xs.mean()),
+                int(ys.mean()),
+                rule.event.name,
+                rule.event.props_for(tags),
+                rule.event.content,
+            )
+        )
+    return tr
 
 
-def generate_map(
-    path: str, x: int, y: int, z: int, conn: psycopg.Connection, tiles: int
-) -> TiledMap:
-    catalog = scan_tileset_folder(Path("demo_tilegame2/spritesheets/"))
+def fetch_options(z: int, tiles: int) -> dict:
+    """Keyword arguments for the retrieve_features functions, based on the rules"""
+    options = dict(tag_filter=get_tag_filter())
+    if FEATURES_PUSHDOWN:
+        options |= dict(tag_keys=get_tag_keys(), cell_size=tile_size_meters(z) / tiles)
+    return options
+
+
+def _tile_layer(id: int, name: str, width: int, height: int) -> Layer:
+    return Layer(
+        height=height,
+        width=width,
+        id=id,
+        name=name,
+        type="tilelayer",
+        data=np.zeros(width * height, dtype=np.uint32),
+        encoding=LAYER_ENCODING,
+        compression=LAYER_COMPRESSION,
+    )
+
+
+def _empty_map(path: str, tiles: int, catalog: TileCatalog) -> TiledMap:
     layers = [
-        Layer(
-            height=tiles,
-            width=tiles,
-            id=1,
-            name="ground",
-            type="tilelayer",
-            data=[0] * (tiles**2),
-        ),
-        Layer(
-            height=tiles,
-            width=tiles,
-            id=2,
-            name="meter1",
-            type="tilelayer",
-            data=[0] * (tiles**2),
-        ),
+        _tile_layer(1, "ground", tiles, tiles),
+        _tile_layer(2, "meter1", tiles, tiles),
     ]
     new_map = TiledMap(
         path=path,
@@ -178,24 +121,192 @@ def generate_map(
         nextlayerid=len(layers) + 1,
         tilesets=catalog.dump_references_for_map(path),
     )
-    bbox = cell_bbox(x, y, z, tiles, conn)
+    new_map.feature_ids = []
+    return new_map
+
+
+def draw_features(
+    features: Iterable[tuple[int, shape, dict]],
+    rules: FeatureRules,
+    bbox: tuple[float, float, float, float],
+    ground: Layer,
+    meter1: Layer,
+) -> Generator[tuple[int, TiledRepresentation], None, None]:
+    """Draw the features on ground and meter1 layers covering bbox.
+
+    Yields the id and the representation of every drawn feature, the events
+    are left to the caller.
+    """
+    width, height = ground.width, ground.height
     min_x, max_x, min_y, max_y = bbox
-    cell_width = (max_x - min_x) / tiles
-    cell_height = (max_y - min_y) / tiles
-    for osm_id, geom, tags in retrieve_features(x, y, z, conn):
+    cell_width = (max_x - min_x) / width
+    cell_height = (max_y - min_y) / height
+    fetched = 0
+    drawn = 0
+    for osm_id, geom, tags in features:
         new_feat = represent_feature(
-            osm_id, geom, tags, catalog, bbox, cell_width, cell_height
+            osm_id, geom, tags, rules, bbox, cell_width, cell_height, width, height
         )
+        fetched += 1
         if new_feat is not None:
-            for (x, y), tid in new_feat.ground.items():
-                new_map.layers[0].set_tile(x, y, tid)
+            merge_start = time.perf_counter()
+            drawn += 1
+            for idx, tid in new_feat.ground:
+                ground.set_tiles(idx, tid)
             # draw this feature on meter1 only if every tile is empty
-            if all(new_map.layers[1].is_empty(x, y) for x, y in new_feat.meter1.keys()):
-                for (x, y), tid in new_feat.meter1.items():
-                    new_map.layers[1].set_tile(x, y, tid)
+            if all(meter1.all_empty(idx) for idx, _ in new_feat.meter1):
+                for idx, tid in new_feat.meter1:
+                    meter1.set_tiles(idx, tid)
+            add_time("merge", time.perf_counter() - merge_start)
+            yield osm_id, new_feat
+    increment("features_fetched", fetched)
+    increment("features_drawn", drawn)
 
-            for event in new_feat.events:
-                new_map.add_event(
-                    event.x, event.y, event.name, event.props, event.content
-                )
+
+def build_map(
+    path: str,
+    features: Iterable[tuple[int, shape, dict]],
+    bbox: tuple[float, float, float, float],
+    tiles: int,
+    catalog: TileCatalog | None = None,
+) -> TiledMap:
+    """Build the map of a tile from its features and its bounds in EPSG:3857"""
+    if catalog is None:
+        catalog = get_catalog()
+    new_map = _empty_map(path, tiles, catalog)
+    ground, meter1 = new_map.layers
+    for osm_id, new_feat in draw_features(
+        features, get_rules(catalog), bbox, ground, meter1
+    ):
+        new_map.feature_ids.append(osm_id)
+        for event in new_feat.events:
+            new_map.add_event(event.x, event.y, event.name, event.props, event.content)
     return new_map
+
+
+def build_region(
+    paths: dict[tuple[int, int], str],
+    features: Iterable[tuple[int, shape, dict]],
+    z: int,
+    tiles: int,
+    catalog: TileCatalog | None = None,
+) -> dict[tuple[int, int], TiledMap]:
+    """Build the maps of a block of tiles drawing every feature only once.
+
+    The features are drawn on layers covering the rectangle around all the
+    tiles, which are then sliced into the maps. Objects crossing the border of
+    two tiles are the same on both sides, and an event belongs to the tile
+    containing its cell instead of being repeated in every tile.
+    """
+    if catalog is None:
+        catalog = get_catalog()
+    min_x = min(x for x, _ in paths)
+    max_x = max(x for x, _ in paths)
+    min_y = min(y for _, y in paths)
+    max_y = max(y for _, y in paths)
+    columns = max_x - min_x + 1
+    rows = max_y - min_y + 1
+    west, _, _, north = tile_envelope(min_x, min_y, z)
+    _, east, south, _ = tile_envelope(max_x, max_y, z)
+    ground = _tile_layer(1, "ground", columns * tiles, rows * tiles)
+    meter1 = _tile_layer(2, "meter1", columns * tiles, rows * tiles)
+    maps = {xy: _empty_map(path, tiles, catalog) for xy, path in paths.items()}
+    # the region grid is the spatial index, the cells of a feature tell
+    # the tiles it was drawn on
+    for osm_id, new_feat in draw_features(
+        features, get_rules(catalog), (west, east, south, north), ground, meter1
+    ):
+        indexes = np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [idx for idx, _ in new_feat.ground + new_feat.meter1]
+        )
+        cell_y, cell_x = np.divmod(indexes, ground.width)
+        for tile in np.unique((cell_y // tiles) * columns + cell_x // tiles).tolist():
+            xy = (min_x + tile % columns, min_y + tile // columns)
+            if xy in maps:
+                maps[xy].feature_ids.append(osm_id)
+        for event in new_feat.events:
+            xy = (min_x + event.x // tiles, min_y + event.y // tiles)
+            if xy in maps:
+                maps[xy].add_event(
+                    event.x % tiles,
+                    event.y % tiles,
+                    event.name,
+                    event.props,
+                    event.content,
+                )
+    for (x, y), tm in maps.items():
+        top = (y - min_y) * tiles
+        left = (x - min_x) * tiles
+        for region_layer, layer in zip((ground, meter1), tm.layers):
+            layer.blit(
+                region_layer.grid()[top : top + tiles, left : left + tiles], 0, 0
+            )
+    return maps
+
+
+def generate_map(
+    path: str, x: int, y: int, z: int, source: FeatureSource, tiles: int
+) -> TiledMap:
+    bbox = tile_envelope(x, y, z)
+    features = source.features(x, y, z, **fetch_options(z, tiles))
+    return build_map(path, features, bbox, tiles)
+
+
+def generate_map_block(
+    paths: dict[tuple[int, int], str],
+    z: int,
+    source: FeatureSource,
+    tiles: int,
+) -> dict[tuple[int, int], TiledMap]:
+    """Generate the maps of many neighbouring tiles with a single fetch.
+
+    paths maps the x, y coordinates of the wanted tiles to their map path,
+    the features are retrieved once for the rectangle containing all of them.
+    """
+    min_x = min(x for x, _ in paths)
+    max_x = max(x for x, _ in paths)
+    min_y = min(y for _, y in paths)
+    max_y = max(y for _, y in paths)
+    catalog = get_catalog()
+    coords = list(paths)
+    envelopes = tile_envelope(
+        np.array([x for x, _ in coords]), np.array([y for _, y in coords]), z
+    )
+    bboxes = {
+        xy: tuple(bounds)
+        for xy, bounds in zip(coords, np.column_stack(envelopes).tolist())
+    }
+    per_tile: dict[tuple[int, int], list[tuple[int, shape, dict]]] = {
+        xy: [] for xy in paths
+    }
+    for osm_id, geom, tags, tile_coords in source.features_block(
+        min_x, min_y, max_x, max_y, z, **fetch_options(z, tiles)
+    ):
+        for xy in tile_coords:
+            if xy in per_tile:
+                per_tile[xy].append((osm_id, geom, tags))
+    return {
+        xy: build_map(paths[xy], per_tile[xy], bboxes[xy], tiles, catalog)
+        for xy in paths
+    }
+
+
+def generate_region(
+    paths: dict[tuple[int, int], str],
+    z: int,
+    source: FeatureSource,
+    tiles: int,
+) -> dict[tuple[int, int], TiledMap]:
+    """Same as generate_map_block, but drawing the block as a single region"""
+    min_x = min(x for x, _ in paths)
+    max_x = max(x for x, _ in paths)
+    min_y = min(y for _, y in paths)
+    max_y = max(y for _, y in paths)
+    features = (
+        (osm_id, geom, tags)
+        for osm_id, geom, tags, _ in source.features_block(
+            min_x, min_y, max_x, max_y, z, **fetch_options(z, tiles)
+        )
+    )
+    return build_region(paths, features, z, tiles)
@@ -0,0 +1,78 @@
+from math import ceil, floor
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+
+def candidate_cells(
+    tile_bbox: tuple[float, float, float, float],
+    geom_bbox: tuple[float, float, float, float],
+    cell_width: float,
+    cell_height: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Lower left corners of the cells to test against a geometry.
+
+    These are the same cells the old per-cell loop walked through:
+    a grid starting one cell before the geometry bounds, clipped to the tile.
+    """
+    min_x, max_x, min_y, max_y = tile_bbox
+    g_min_x, g_min_y, g_max_x, g_max_y = geom_bbox
+    start_x = max(g_min_x, min_x) - cell_width
+    stop_x = min(max_x, g_max_x)
+    start_y = max(g_min_y, min_y) - cell_height
+    stop_y = min(max_y, g_max_y) + cell_height
+    if stop_x <= start_x or stop_y < start_y:
+        return np.empty(0), np.empty(0)
+    # one extra step to be safe with float rounding, filtered right after
+    cols = start_x + np.arange(ceil((stop_x - start_x) / cell_width) + 1) * cell_width
+    rows = (
+        start_y + np.arange(floor((stop_y - start_y) / cell_height) + 2) * cell_height
+    )
+    cols = cols[(cols < stop_x) & (cols >= min_x)]
+    rows = rows[(rows <= stop_y) & (rows > min_y)]
+    origin_x, origin_y = np.meshgrid(cols, rows)
+    return origin_x.ravel(), origin_y.ravel()
+
+
+def covered_cells(
+    geom: shape,
+    tile_bbox: tuple[float, float, float, float],
+    cell_width: float,
+    cell_height: float,
+    width: int,
+    height: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Grid coordinates of all the cells intersecting the geometry.
+
+    All the cell boxes are built and tested in a single vectorized call.
+    Returns two integer arrays, x and y, with the y coordinate following
+    the computer graphic convention (grows going south).
+    """
+    # bounds of an empty geometry are NaN, and it covers nothing anyway
+    if geom.is_empty:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    origin_x, origin_y = candidate_cells(
+        tile_bbox, geom.bounds, cell_width, cell_height
+    )
+    if len(origin_x) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    boxes = shapely.box(
+        origin_x, origin_y, origin_x + cell_width, origin_y + cell_height
+    )
+    # many boxes against the same geometry, preparing it pays off
+    shapely.prepare(geom)
+    hits = shapely.intersects(boxes, geom)
+    min_x, _, _, max_y = tile_bbox
+    # trunc() behaves like int(), which is what the cell indexing always used,
+    # the small offset avoids off-by-one errors when a cell is on a grid line
+    xs = np.trunc((origin_x[hits] - min_x) / cell_width + 1e-9).astype(np.int64)
+    ys = np.trunc((max_y - origin_y[hits]) / cell_height + 1e-9).astype(np.int64)
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    return xs[inside], ys[inside]
+
+
+def flat_index(xs: np.ndarray, ys: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Indexes in the layer data of the given cells, dropping the ones outside"""
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    return xs[inside] + ys[inside] * width
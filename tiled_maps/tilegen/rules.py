@@ -0,0 +1,181 @@
+"""Rules deciding how OSM features are drawn, loaded from a YAML file.
+
+The rules are compiled once per tile catalog into an index by tag key and
+value with the tile ids already resolved, so classifying a feature does not
+get slower when rules are added. Check a rules file with:
+
+    python -m tiled_maps.tilegen.rules tiled_maps/tilegen/rules.yaml
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from os import environ
+from pathlib import Path
+
+import yaml
+
+from tiled_maps.tiled_helpers.tile_catalog import get_catalog, TileCatalog
+
+TILE_RULES_PATH = Path(
+    environ.get("TILE_RULES_PATH", Path(__file__).parent / "rules.yaml")
+)
+
+
+@dataclass
+class EventTemplate:
+    name: str
+    # event property name -> (tag to read, default when the tag is missing)
+    props: dict[str, tuple[str, str]]
+    content: list[any]
+
+    def props_for(self, tags: dict) -> dict:
+        return {
+            prop: tags.get(tag, default) for prop, (tag, default) in self.props.items()
+        }
+
+
+@dataclass
+class CompiledRule:
+    # position in the rules file, lower wins
+    priority: int
+    # tile id for the ground layer, if any
+    ground: int | None
+    # (dx, dy, tile id) of the meter1 drawing
+    meter1: list[tuple[int, int, int]]
+    event: EventTemplate | None
+
+
+@dataclass
+class FeatureRules:
+    # tag key -> (rule matching any value, rules by value)
+    index: dict[str, tuple[CompiledRule | None, dict[str, CompiledRule]]]
+    # tag key -> accepted values, None for any, what the features are fetched by
+    tag_filter: list[tuple[str, list[str] | None]]
+
+    def classify(self, tags: dict | None) -> CompiledRule | None:
+        """The rule with the highest priority matching the tags, if any"""
+        if not tags:
+            return None
+        best = None
+        # look up the smallest of the two, the result is the same
+        keys = tags if len(tags) < len(self.index) else self.index
+        for key in keys:
+            if key not in self.index or key not in tags:
+                continue
+            any_value, by_value = self.index[key]
+            for rule in (any_value, by_value.get(tags[key])):
+                if rule is not None and (best is None or rule.priority < best.priority):
+                    best = rule
+        return best
+
+
+def load_rules(path: Path = TILE_RULES_PATH) -> list[dict]:
+    with open(path) as fr:
+        raw = yaml.safe_load(fr)
+    rules = raw.get("rules", [])
+    for idx, rule in enumerate(rules):
+        if "key" not in rule.get("match", {}):
+            raise ValueError(f"Rule {idx} in {path} has no match key")
+        if not any(k in rule for k in ("ground", "meter1", "event")):
+            raise ValueError(f"Rule {idx} in {path} draws nothing")
+    return rules
+
+
+def tag_filter(rules: list[dict]) -> list[tuple[str, list[str] | None]]:
+    """The tag keys and values of all the rules, merged by key"""
+    merged: dict[str, set[str] | None] = {}
+    for rule in rules:
+        key = rule["match"]["key"]
+        values = rule["match"].get("values")
+        if values is None or (key in merged and merged[key] is None):
+            merged[key] = None
+        else:
+            merged[key] = merged.get(key, set()) | {str(v) for v in values}
+    return [
+        (key, None if values is None else sorted(values))
+        for key, values in merged.items()
+    ]
+
+
+def tag_keys(rules: list[dict]) -> list[str]:
+    """The tag keys the rules read, to match a feature or to fill an event"""
+    keys = {rule["match"]["key"] for rule in rules}
+    for rule in rules:
+        for spec in rule.get("event", {}).get("props", {}).values():
+            keys.add(spec["tag"])
+    return sorted(keys)
+
+
+def compile_rules(rules: list[dict], catalog: TileCatalog) -> FeatureRules:
+    index: dict[str, tuple[CompiledRule | None, dict[str, CompiledRule]]] = {}
+    for priority, rule in enumerate(rules):
+        event = None
+        if "event" in rule:
+            event = EventTemplate(
+                name=rule["event"]["name"],
+                props={
+                    prop: (spec["tag"], spec.get("default", ""))
+                    for prop, spec in rule["event"].get("props", {}).items()
+                },
+                content=rule["event"].get("content", []),
+            )
+        compiled = CompiledRule(
+            priority=priority,
+            ground=(
+                catalog.get_tile_by_name(rule["ground"]) if "ground" in rule else None
+            ),
+            meter1=[
+                (dx, dy, catalog.get_tile_by_name(tile_name))
+                for dx, dy, tile_name in rule.get("meter1", [])
+            ],
+            event=event,
+        )
+        key = rule["match"]["key"]
+        any_value, by_value = index.get(key, (None, {}))
+        if "values" not in rule["match"]:
+            # an earlier rule always wins
+            if any_value is None:
+                any_value = compiled
+        else:
+            for value in rule["match"]["values"]:
+                by_value.setdefault(str(value), compiled)
+        index[key] = (any_value, by_value)
+    return FeatureRules(index=index, tag_filter=tag_filter(rules))
+
+
+@lru_cache(maxsize=1)
+def _rules_from_file(path: Path) -> list[dict]:
+    return load_rules(path)
+
+
+@lru_cache(maxsize=4)
+def _compiled(catalog: TileCatalog, path: Path) -> FeatureRules:
+    return compile_rules(_rules_from_file(path), catalog)
+
+
+def get_rules(
+    catalog: TileCatalog | None = None, path: Path = TILE_RULES_PATH
+) -> FeatureRules:
+    """The compiled rules for a catalog, the file is read once per process"""
+    if catalog is None:
+        catalog = get_catalog()
+    return _compiled(catalog, path)
+
+
+def get_tag_filter(path: Path = TILE_RULES_PATH) -> list[tuple[str, list[str] | None]]:
+    """Same as get_rules().tag_filter, without resolving the tiles"""
+    return tag_filter(_rules_from_file(path))
+
+
+def get_tag_keys(path: Path = TILE_RULES_PATH) -> list[str]:
+    return tag_keys(_rules_from_file(path))
+
+
+if __name__ == "__main__":
+    import sys
+
+    rules_path = Path(sys.argv[1]) if len(sys.argv) > 1 else TILE_RULES_PATH
+    compiled = compile_rules(load_rules(rules_path), get_catalog())
+    print("Rules are valid, features are fetched by these tags:")
+    for key, values in compiled.tag_filter:
+        print(f"  {key}: {'any value' if values is None else ', '.join(values)}")
@@ -0,0 +1,295 @@
+"""Generated chunks in two files instead of many small ones.
+
+The tile layers of every chunk are fixed size uint32 grids in a single
+file, read through a memory map without copies. A SQLite table next to it
+maps each chunk to its grids and holds its events and the tileset
+references it was generated with, the firstgids depend on the spritesheets
+there were at the time. The Tiled JSON is assembled only when a chunk is
+served. Enable it with WORLD_STORE_PATH, and write the chunks as files
+again, for example to serve them with nginx:
+
+    python -m tiled_maps.world_store --export
+    python -m tiled_maps.world_store --export --chunks -10 -10 10 10
+
+A regenerated chunk gets new grids, the space of the old ones is not
+reclaimed. Exporting and generating a new store does that.
+"""
+
+import os
+from pathlib import Path
+import sqlite3
+import threading
+
+import numpy as np
+import orjson
+
+from tiled_maps.tiled_helpers.tilemap import Layer, TiledMap, TileSetRef
+
+# grid files mapped by this process, remapped when they grow
+_mapped: dict[Path, np.memmap] = {}
+# stores this process already created, writers skip the schema after that
+_created: set[Path] = set()
+# read only connections, one per thread since they are not thread safe
+_readers = threading.local()
+
+
+def grids_path(path: Path) -> Path:
+    return path.with_suffix(".grids")
+
+
+def open_store(path: Path) -> sqlite3.Connection:
+    """A connection to write in the store, creating it the first time"""
+    # many processes write here, wait for the others instead of failing
+    conn = sqlite3.connect(path, timeout=30)
+    if path in _created:
+        return conn
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID"
+    )
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('slots', 0)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chunk (
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            events BLOB NOT NULL,
+            tilesets BLOB NOT NULL,
+            PRIMARY KEY (x, y)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.commit()
+    _created.add(path)
+    return conn
+
+
+def _reader(path: Path) -> sqlite3.Connection | None:
+    """The read only connection of this thread, None if there is no store.
+
+    Reads never take the write lock, in WAL mode they do not wait for the
+    writers and see the last committed chunks.
+    """
+    conns = _readers.__dict__.setdefault("conns", {})
+    # a forked process must not use the connections of its parent
+    key = (os.getpid(), path)
+    if key not in conns:
+        if not path.exists():
+            return None
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            conn.execute("SELECT 1 FROM chunk LIMIT 1")
+        except sqlite3.OperationalError:
+            # the first writer did not create the tables yet
+            conn.close()
+            return None
+        conns[key] = conn
+    return conns[key]
+
+
+def _layout(tm: TiledMap) -> dict:
+    """What every map in a store has in common, except the tile ids"""
+    return dict(
+        width=tm.width,
+        height=tm.height,
+        tilewidth=tm.tilewidth,
+        tileheight=tm.tileheight,
+        layers=[
+            dict(
+                id=layer.id,
+                name=layer.name,
+                encoding=layer.encoding,
+                compression=layer.compression,
+            )
+            for layer in tm.layers
+            if layer.type == "tilelayer"
+        ],
+    )
+
+
+def _read_layout(conn: sqlite3.Connection) -> dict | None:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+    return None if row is None else orjson.loads(row[0])
+
+
+def put_chunk(path: Path, x: int, y: int, tm: TiledMap) -> int:
+    """Store or replace the map of a chunk, returns its new version.
+
+    All the maps of a store must have the same size and tile layers.
+    """
+    layout = _layout(tm)
+    grids = np.stack(
+        [
+            np.asarray(layer.data, dtype=np.uint32).reshape(tm.height, tm.width)
+            for layer in tm.layers
+            if layer.type == "tilelayer"
+        ]
+    )
+    events = orjson.dumps(
+        [
+            [*data, *files]
+            for data, files in zip(tm.event_data or [], tm.event_files or [])
+        ]
+    )
+    tilesets = orjson.dumps([tsr.to_dict() for tsr in tm.tilesets])
+    conn = open_store(path)
+    fd = os.open(grids_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with conn:
+            # taking a slot is the first write, it locks the store until the
+            # commit so growing the grids file is not concurrent
+            (slot,) = conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE key = 'slots' "
+                "RETURNING value - 1"
+            ).fetchone()
+            stored_layout = _read_layout(conn)
+            if stored_layout is None:
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('layout', ?)",
+                    (orjson.dumps(layout),),
+                )
+            elif stored_layout != layout:
+                raise ValueError(
+                    f"Map of chunk {x, y} does not fit the store: "
+                    f"{layout} instead of {stored_layout}"
+                )
+            needed = (slot + 1) * grids.nbytes
+            if os.fstat(fd).st_size < needed:
+                os.ftruncate(fd, needed)
+            os.pwrite(fd, grids.tobytes(), slot * grids.nbytes)
+            # readers see the chunk only now, with its grids already there
+            conn.execute(
+                "INSERT OR REPLACE INTO chunk (x, y, slot, events, tilesets) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (x, y, slot, events, tilesets),
+            )
+    finally:
+        os.close(fd)
+        conn.close()
+    return slot
+
+
+def _grids(path: Path, slot: int, shape: tuple[int, int, int]) -> np.ndarray:
+    """The grids in a slot, a read only view of the memory map"""
+    mapped = _mapped.get(path)
+    if mapped is None or slot >= mapped.shape[0]:
+        mapped = np.memmap(grids_path(path), dtype=np.uint32, mode="r").reshape(
+            -1, *shape
+        )
+        _mapped[path] = mapped
+    return mapped[slot]
+
+
+def _chunk_row(path: Path, x: int, y: int) -> tuple[dict, int, bytes, bytes] | None:
+    conn = _reader(path)
+    if conn is None:
+        return None
+    row = conn.execute(
+        "SELECT slot, events, tilesets FROM chunk WHERE x = ? AND y = ?", (x, y)
+    ).fetchone()
+    if row is None:
+        return None
+    return _read_layout(conn), *row
+
+
+def chunk_version(path: Path, x: int, y: int) -> int | None:
+    """Changes every time the chunk is stored, None if it's not there"""
+    row = _chunk_row(path, x, y)
+    return None if row is None else row[1]
+
+
+def load_map(path: Path, x: int, y: int, map_path: Path) -> tuple[TiledMap, int] | None:
+    """The map of a chunk and its version, None if it's not stored.
+
+    The layer data are views of the memory map, they cannot be changed.
+    """
+    row = _chunk_row(path, x, y)
+    if row is None:
+        return None
+    layout, slot, events, tilesets = row
+    grids = _grids(
+        path, slot, (len(layout["layers"]), layout["height"], layout["width"])
+    )
+    layers = [
+        Layer(
+            height=layout["height"],
+            width=layout["width"],
+            type="tilelayer",
+            data=grid.reshape(-1),
+            **layer,
+        )
+        for layer, grid in zip(layout["layers"], grids)
+    ]
+    tm = TiledMap(
+        path=map_path,
+        height=layout["height"],
+        width=layout["width"],
+        tileheight=layout["tileheight"],
+        tilewidth=layout["tilewidth"],
+        layers=layers,
+        nextobjectid=1,
+        nextlayerid=len(layers) + 1,
+        tilesets=[TileSetRef(**tsrd) for tsrd in orjson.loads(tilesets)],
+    )
+    events = orjson.loads(events)
+    if len(events) > 0:
+        tm.event_data = [
+            (ev_x, ev_y, name, props) for ev_x, ev_y, name, props, _, _ in events
+        ]
+        tm.event_files = [
+            (event_path, content) for _, _, _, _, event_path, content in events
+        ]
+    return tm, slot
+
+
+def event_file(path: Path, x: int, y: int, event_path: str) -> str | None:
+    """Content of an event file of a chunk, by its path relative to the map"""
+    row = _chunk_row(path, x, y)
+    if row is None:
+        return None
+    for _, _, _, _, stored_path, content in orjson.loads(row[2]):
+        if stored_path == event_path:
+            return content
+    return None
+
+
+def stored_chunks(path: Path) -> set[tuple[int, int]]:
+    conn = _reader(path)
+    if conn is None:
+        return set()
+    return set(conn.execute("SELECT x, y FROM chunk").fetchall())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from tiled_maps.chunks import WORLD_STORE_PATH, load_chunk, write_chunk_files
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="write the stored chunks as map and event files",
+    )
+    parser.add_argument(
+        "--chunks",
+        nargs=4,
+        type=int,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="rectangle of chunk coordinates, extremes included, default all",
+    )
+    args = parser.parse_args()
+    if not args.export:
+        parser.error("nothing to do, use --export")
+    if WORLD_STORE_PATH is None:
+        parser.error("WORLD_STORE_PATH is not set")
+    chunks = stored_chunks(WORLD_STORE_PATH)
+    if args.chunks is not None:
+        min_x, min_y, max_x, max_y = args.chunks
+        chunks = {
+            (x, y) for x, y in chunks if min_x <= x <= max_x and min_y <= y <= max_y
+        }
+    for x, y in sorted(chunks):
+        write_chunk_files(load_chunk(x, y)[0], x, y)
+    print(f"Exported {len(chunks)} chunks")